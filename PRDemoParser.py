@@ -1,89 +1,420 @@
 import sys
+import argparse
 import struct
+import array
 import zlib
-import cStringIO
+import hashlib
+import cPickle
+import sqlite3
 import json
+import re
 import os, os.path
 import errno
 from collections import namedtuple
 from fnmatch import fnmatch
+from functools import partial
 import datetime
 import multiprocessing
-from bs4 import BeautifulSoup
+from multiprocessing.pool import ThreadPool
+import threading
+from HTMLParser import HTMLParser
 import requests
-import urllib
 import numpy as np
 import time
-from shutil import copyfile
+from shutil import copyfile, copytree, rmtree
 import urlparse
-from pyheatmap.heatmap import HeatMap
+from PIL import Image, ImageColor, PngImagePlugin
 ###############################
 #           HELPERS           #
 ###############################
 
-# Helper functions to turn json files into namedtuple
-def _json_object_hook(d): return namedtuple('X', d.keys())(*d.values())
+# Helper functions to turn json files into namedtuple. The namedtuple types are cached by their keys, because
+# creating a type for every decoded object is what makes decoding large files slow.
+_jsonRecordTypes = {}
+
+
+def _json_object_hook(d):
+    keys = tuple(d.keys())
+    recordType = _jsonRecordTypes.get(keys)
+    if recordType is None:
+        recordType = _jsonRecordTypes[keys] = namedtuple('X', keys)
+    return recordType(*d.values())
+
 def json2obj(data): return json.loads(data, object_hook=_json_object_hook)
 
-def generateHeatMap(map):
-    mapHeatMapData = []
-    gameModeChanged = False
-    for gameModeIndex, gameMode in enumerate(map.gameModes, start=0):
-        gameModeHeatMapData = []
-        layerChanged = False
-        for layerIndex, layer in enumerate(gameMode.layers, start=0):
-            layerHeatMapData = []
-            routeChanged = False
-            for routeIndex, route in enumerate(layer.routes, start=0):
-                if route.updated:
-                    routeChanged = True
-                    routeHeatMapMatrix = np.zeros(shape=(512, 512))
-                    routeHeatMapName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement_" + gameMode.name + "_" + layer.name + "_" + route.id
-                    try:
-                        importedRouteHeatMap = np.load(str(routeHeatMapName + ".npy"))
-                        routeHeatMapMatrix = routeHeatMapMatrix + importedRouteHeatMap
-                    except Exception, e:
-                        pass
-                    for parsedDemo in route.roundsPlayed:
-                        if type(parsedDemo.heatMap) is not type(None):
-                            routeHeatMapMatrix = routeHeatMapMatrix + parsedDemo.heatMap
-                    if not os.path.exists("./data/" + map.versionname + "/" + map.name):
-                        os.makedirs("./data/" + map.versionname + "/" + map.name)
-                    np.save(routeHeatMapName, routeHeatMapMatrix)
-                    routeHeatMapData = []
-                    for ix, iy in np.ndindex(routeHeatMapMatrix.shape):
-                        for count in range(0, int(routeHeatMapMatrix[ix, iy])):
-                            routeHeatMapData.append([ix, iy])
-                    HeatMap(data=routeHeatMapData, width=512, height=512).heatmap(save_as=routeHeatMapName + ".png")
-                    layerHeatMapData.extend(routeHeatMapData)
-            if routeChanged:
-                layerChanged = True
-                layerHeatMapFileName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement_" + gameMode.name + "_" + layer.name + ".png"
-                if len(layer.routes) > 1:
-                    HeatMap(data=layerHeatMapData, width=512, height=512).heatmap(save_as=layerHeatMapFileName)
-                else:
-                    routeHeatMapFileName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement_" + gameMode.name + "_" + layer.name + "_" + \
-                                           layer.routes[0].id + ".png"
-                    copyfile(routeHeatMapFileName, layerHeatMapFileName)
-                gameModeHeatMapData.extend(layerHeatMapData)
-        if layerChanged:
-            gameModeChanged = True
-            gameModeHeatMapFileName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement_" + gameMode.name + ".png"
-            if len(gameMode.layers) > 1:
-                HeatMap(data=gameModeHeatMapData, width=512, height=512).heatmap(save_as=gameModeHeatMapFileName)
-            else:
-                layerHeatMapFileName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement_" + gameMode.name + "_" + \
-                                       gameMode.layers[0].name + ".png"
-                copyfile(layerHeatMapFileName, gameModeHeatMapFileName)
-            mapHeatMapData.extend(gameModeHeatMapData)
-    if gameModeChanged:
-        mapHeatMapFileName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement" + ".png"
-        if len(map.gameModes) > 1:
-            HeatMap(data=mapHeatMapData, width=512, height=512).heatmap(save_as=mapHeatMapFileName)
+# Helper function to turn objects into JSON. Attributes starting with an underscore, such as indexes, are left out.
+def jsonFields(o): return dict((key, value) for key, value in o.__dict__.iteritems() if not key.startswith('_'))
+
+# Radius in pixels of the circle every position is spread over when rendering a heatmap. Overview images use a radius
+# in proportion to their size.
+HEATMAPRADIUS = 10
+
+# Size in pixels of the heatmap PNGs, which are shown on the 512x512 minimaps, and of the smaller overview PNGs that
+# are saved next to them as name_size.png.
+HEATMAPIMAGESIZE = 512
+HEATMAPOVERVIEWSIZES = (256, 128)
+
+# Size in pixels of the tiles of the zoom levels of heatmaps with a higher resolution than HEATMAPIMAGESIZE
+HEATMAPTILESIZE = 256
+
+# Resolution of the heatmap count matrices of a map by its scale, HEATMAPIMAGESIZE for other scales. A map can set its
+# own with "heatMapResolution" in maps.json, which has to be a power of two of at least HEATMAPIMAGESIZE.
+HEATMAPRESOLUTIONS = {4: 1024, 8: 1024}
+
+# Types of the heatmap channels that can be collected next to the heatmap of the whole round, with --heatmap-channels
+HEATMAPCHANNELTYPES = ["time", "team", "vehicle"]
+
+# Length in seconds of the time slices of a round. With the "time" channels every time slice gets its own heatmap
+# channel, named after the minute it starts at such as _time10, and the last one also holds the rest of the round.
+HEATMAPTIMESLICE = 600
+HEATMAPTIMESLICES = 12
+
+# Player group of a position by the team of the player, plus one when the player is in a vehicle. Players in another
+# team are in HEATMAPNOTEAMGROUP.
+HEATMAPTEAMGROUPS = {1: 0, 2: 2}
+HEATMAPNOTEAMGROUP = 4
+HEATMAPGROUPS = 6
+
+# Heatmap channels of the player groups, with their channel type and the groups they sum up
+HEATMAPGROUPCHANNELS = [("_team1", "team", (0, 1)), ("_team2", "team", (2, 3)), ("_infantry", "vehicle", (0, 2, 4)),
+                        ("_vehicle", "vehicle", (1, 3, 5))]
+
+# Update player fields the player groups of the channel types depend on
+HEATMAPCHANNELPLAYERFIELDS = {"team": frozenset(['team']), "vehicle": frozenset(['vehicle'])}
+
+# Share of the cells of a heatmap channel that can be filled before its sum is kept as a dense matrix
+HEATMAPSPARSESHARE = 0.25
+
+# Number of colors in the heatmap palette.
+HEATMAPCOLORCOUNT = 240
+
+
+# Helper function to create the circle every position is spread over when rendering a heatmap, as a list of
+# (offset, weight) in a flattened image of the given width. Uses the midpoint circle algorithm, weighing every pixel
+# by its distance to the edge, and wraps around rows the same way the offsets in a flattened image do.
+def heatMapCircle(radius, width):
+    circle = {}
+    x = 0
+    y = radius
+    d = 3 - (radius << 1)
+    while x <= y:
+        for circleY in range(x, y + 1):
+            weight = y + 1 - circleY
+            for offsetX, offsetY in ((x, circleY), (-x, circleY), (x, -circleY), (-x, -circleY),
+                                     (circleY, x), (-circleY, x), (circleY, -x), (-circleY, -x)):
+                circle.setdefault(width * offsetY + offsetX, weight)
+        if d < 0:
+            d += (x << 2) + 6
+        else:
+            d += ((x - y) << 2) + 10
+            y -= 1
+        x += 1
+    return sorted(circle.items())
+
+
+# Helper function to create the heatmap palette as an array of RGBA colors, from transparent blue for the
+# lowest density over blue, green and yellow to red for the highest density.
+def heatMapColors():
+    lightColorCount = int(HEATMAPCOLORCOUNT * 0.4)
+    colors = []
+    for i in range(lightColorCount):
+        lightness = 100 * (lightColorCount - i // 2) // lightColorCount
+        if lightness > 50:
+            colors.append((0, 0, 255, 255 - 255 * (lightness - 50) // 50))
         else:
-            gameModeHeatMapFileName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement_" + \
-                                      map.gameModes[0].name + ".png"
-            copyfile(gameModeHeatMapFileName, mapHeatMapFileName)
+            colors.append(ImageColor.getcolor("hsl(240, 100%, " + str(lightness) + "%)", "RGBA"))
+    hueColorCount = HEATMAPCOLORCOUNT - lightColorCount
+    for i in range(hueColorCount):
+        hue = "%.0f" % (240 * (1.0 - float(i) / hueColorCount))
+        colors.append(ImageColor.getcolor("hsl(" + hue + ", 100%, 50%)", "RGBA"))
+    return np.array(colors, dtype=np.uint8)
+
+
+HEATMAPCOLORS = heatMapColors()
+heatMapCircles = {}
+
+
+# Helper function to change the resolution of a heatmap count matrix by a power of two. Counts are summed when it gets
+# smaller and kept in the first cell of their block when it gets larger, so the total stays the same.
+def resizeHeatMap(heatMapMatrix, resolution):
+    size = heatMapMatrix.shape[0]
+    if resolution < size:
+        factor = size / resolution
+        return heatMapMatrix.reshape(resolution, factor, resolution, factor).sum(axis=(1, 3)).astype(
+            heatMapMatrix.dtype)
+    if resolution > size:
+        factor = resolution / size
+        resizedMatrix = np.zeros(shape=(resolution, resolution), dtype=heatMapMatrix.dtype)
+        resizedMatrix[::factor, ::factor] = heatMapMatrix
+        return resizedMatrix
+    return heatMapMatrix
+
+
+# Return the hash of the count matrix a heatmap PNG was rendered from, or None when there is no such PNG
+def heatMapImageHash(fileName):
+    try:
+        return Image.open(fileName).info.get("matrixhash")
+    except IOError:
+        return None
+
+
+# Render a heatmap count matrix, indexed [x, y], to an RGBA image array. Every count is spread over a circle around
+# its cell, the resulting density is scaled to the palette and cells without density are left transparent. Works on
+# the matrix directly, so memory use doesn't depend on the number of positions in it.
+def renderHeatMap(heatMapMatrix, radius=HEATMAPRADIUS):
+    width, height = heatMapMatrix.shape
+    if (radius, width) not in heatMapCircles:
+        heatMapCircles[(radius, width)] = heatMapCircle(radius, width)
+    counts = np.asarray(heatMapMatrix).T.ravel().astype(np.int64)
+    size = counts.size
+    density = np.zeros(size, dtype=np.int64)
+    for offset, weight in heatMapCircles[(radius, width)]:
+        if offset >= 0:
+            density[offset:] += counts[:size - offset] * weight
+        else:
+            density[:size + offset] += counts[-offset:] * weight
+    image = np.zeros((size, 4), dtype=np.uint8)
+    maxDensity = density.max()
+    if maxDensity > 0:
+        levels = (density * (float(HEATMAPCOLORCOUNT) / maxDensity)).astype(np.int64) - 1
+        painted = levels > 0
+        image[painted] = HEATMAPCOLORS[levels[painted]]
+    return image.reshape(height, width, 4)
+
+
+# Render the PNGs of a heatmap count matrix: name.png of HEATMAPIMAGESIZE, the smaller overviews and, with tiles, the
+# tiles of every zoom level up to the resolution of the matrix as name_tiles/size/column_row.png. Tiles without any
+# density are left out. The hash of the counts is stored in name.png, which is written last, and the PNGs aren't
+# rendered again when they were already rendered from the same counts. Returns whether the PNGs were written.
+def renderHeatMapImages(heatMapMatrix, heatMapName, tiles=False):
+    matrixHash = hashlib.sha1(repr((HEATMAPIMAGESIZE, HEATMAPOVERVIEWSIZES, tiles)))
+    matrixHash.update(np.ascontiguousarray(heatMapMatrix, dtype=np.int64))
+    matrixHash = matrixHash.hexdigest()
+    if heatMapImageHash(heatMapName + ".png") == matrixHash:
+        return False
+    rmtree(heatMapName + "_tiles", ignore_errors=True)
+    resolution = heatMapMatrix.shape[0]
+    if tiles:
+        size = HEATMAPIMAGESIZE * 2
+        while size <= resolution:
+            tilePath = heatMapName + "_tiles/" + str(size)
+            mkdir_p(tilePath)
+            image = renderHeatMap(resizeHeatMap(heatMapMatrix, size))
+            for row in range(size / HEATMAPTILESIZE):
+                for column in range(size / HEATMAPTILESIZE):
+                    tile = image[row * HEATMAPTILESIZE:(row + 1) * HEATMAPTILESIZE,
+                                 column * HEATMAPTILESIZE:(column + 1) * HEATMAPTILESIZE]
+                    if tile[:, :, 3].any():
+                        Image.fromarray(tile, "RGBA").save(
+                            tilePath + "/" + str(column) + "_" + str(row) + ".png")
+            size *= 2
+    imageMatrix = resizeHeatMap(heatMapMatrix, HEATMAPIMAGESIZE)
+    for size in HEATMAPOVERVIEWSIZES:
+        Image.fromarray(renderHeatMap(resizeHeatMap(imageMatrix, size),
+                                      max(1, HEATMAPRADIUS * size / HEATMAPIMAGESIZE)), "RGBA").save(
+            heatMapName + "_" + str(size) + ".png")
+    imageInfo = PngImagePlugin.PngInfo()
+    imageInfo.add_text("matrixhash", matrixHash)
+    Image.fromarray(renderHeatMap(imageMatrix), "RGBA").save(heatMapName + ".png", pnginfo=imageInfo)
+    return True
+
+
+# Copy the PNGs of a heatmap to a heatmap with the same count matrix, unless they were already copied
+def copyHeatMapImages(sourceHeatMapName, heatMapName):
+    if heatMapImageHash(heatMapName + ".png") == heatMapImageHash(sourceHeatMapName + ".png"):
+        return
+    rmtree(heatMapName + "_tiles", ignore_errors=True)
+    if os.path.isdir(sourceHeatMapName + "_tiles"):
+        copytree(sourceHeatMapName + "_tiles", heatMapName + "_tiles")
+    for size in HEATMAPOVERVIEWSIZES:
+        copyfile(sourceHeatMapName + "_" + str(size) + ".png", heatMapName + "_" + str(size) + ".png")
+    copyfile(sourceHeatMapName + ".png", heatMapName + ".png")
+
+
+# Type of the cells of the saved heatmap count matrices
+HEATMAPDTYPE = np.uint32
+
+# Journal of the changes to the saved count matrices of a map, in the folder of the map
+HEATMAPJOURNALNAME = "heatmaps.journal"
+
+
+# Return the saved count matrix of a heatmap memory-mapped read-only, or None when it isn't saved. Matrices saved by
+# older versions in another type or in another resolution are converted in memory instead, as they are replaced when
+# they change.
+def loadHeatMapMatrix(heatMapName, resolution):
+    try:
+        heatMapMatrix = np.load(str(heatMapName + ".npy"), mmap_mode='r')
+    except Exception, e:
+        return None
+    if heatMapMatrix.dtype != HEATMAPDTYPE or heatMapMatrix.shape != (resolution, resolution):
+        heatMapMatrix = resizeHeatMap(np.array(heatMapMatrix, dtype=HEATMAPDTYPE), resolution)
+    return heatMapMatrix
+
+
+# Add the change of a count matrix to a list of changes as (name, create, shape, indices, counts). Only the cells of the
+# new heatmap are changed in the saved matrix, unless it has to be created because it isn't saved or was converted by
+# loadHeatMapMatrix.
+def addHeatMapChange(changes, heatMapName, heatMapMatrix, savedMatrix, newHeatMap):
+    create = not isinstance(savedMatrix, np.memmap)
+    if create:
+        indices = np.flatnonzero(heatMapMatrix)
+    else:
+        indices = np.flatnonzero(newHeatMap)
+    changes.append((heatMapName, create, heatMapMatrix.shape, indices.astype(np.uint32),
+                    heatMapMatrix.ravel()[indices].astype(HEATMAPDTYPE)))
+
+
+# Write changes to the saved count matrices in place through memory maps. Created matrices are written to a temporary
+# file first. Applying the same changes again gives the same result, so they can be replayed from the journal.
+def applyHeatMapChanges(changes):
+    for heatMapName, create, shape, indices, counts in changes:
+        fileName = str(heatMapName + ".npy")
+        if create:
+            heatMapMatrix = np.lib.format.open_memmap(fileName + ".tmp", mode='w+', dtype=HEATMAPDTYPE, shape=shape)
+        else:
+            heatMapMatrix = np.load(fileName, mmap_mode='r+')
+        heatMapMatrix.reshape(-1)[indices] = counts
+        heatMapMatrix.flush()
+        del heatMapMatrix
+        if create:
+            replaceFile(fileName + ".tmp", fileName)
+
+
+# Apply the changes to the saved count matrices of a map at once. The changes are written to the journal of the map
+# before they are applied and the journal is removed after, so a run that is interrupted while applying them can't
+# leave the matrices of the map half updated.
+def commitHeatMapChanges(mapPath, changes):
+    journalPath = os.path.join(mapPath, HEATMAPJOURNALNAME)
+    with open(journalPath + ".tmp", 'wb') as f:
+        cPickle.dump(changes, f, cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    replaceFile(journalPath + ".tmp", journalPath)
+    applyHeatMapChanges(changes)
+    os.remove(journalPath)
+
+
+# Apply the changes that are left in the journal of a map by an interrupted run
+def recoverHeatMapChanges(mapPath):
+    journalPath = os.path.join(mapPath, HEATMAPJOURNALNAME)
+    try:
+        with open(journalPath, 'rb') as f:
+            changes = cPickle.load(f)
+    except IOError:
+        return
+    applyHeatMapChanges(changes)
+    os.remove(journalPath)
+
+
+# Bring the count matrix and PNG of a level of the heatmaps of a map up to date. A level is a route or a layer,
+# gamemode or map that sums up its parts, as a (name, parts, new heatmap, updated) tuple where name is the path of its
+# files without extension. Routes add their new heatmap to their saved count matrix. Levels with several parts add the
+# new heatmaps of their parts to their own saved count matrix, or sum up the count matrices of their parts when it
+# isn't saved yet, and levels with a single part share the count matrix and PNG of that part. Only levels with updated
+# routes are visited unless loadMatrix is set. The changes to the saved matrices are added to changes and the PNGs to
+# render to images, as (name, count matrix or name of the part to copy the PNG of). All count matrices of a map have
+# the resolution of the map. Returns the count matrix and the sum of the new heatmaps of the level.
+def updateHeatMapLevel(level, resolution, changes, images, loadMatrix=False):
+    heatMapName, parts, newHeatMap, updated = level
+    if not updated and not loadMatrix:
+        return None, None
+    if parts is None:
+        savedMatrix = loadHeatMapMatrix(heatMapName, resolution)
+        heatMapMatrix = savedMatrix
+        if heatMapMatrix is None:
+            heatMapMatrix = np.zeros(shape=(resolution, resolution), dtype=HEATMAPDTYPE)
+        if newHeatMap is not None:
+            heatMapMatrix = heatMapMatrix + newHeatMap
+            addHeatMapChange(changes, heatMapName, heatMapMatrix, savedMatrix, newHeatMap)
+    elif len(parts) == 1:
+        heatMapMatrix, newHeatMap = updateHeatMapLevel(parts[0], resolution, changes, images, loadMatrix)
+        if updated:
+            images.append((heatMapName, parts[0][0]))
+        return heatMapMatrix, newHeatMap
+    else:
+        savedMatrix = loadHeatMapMatrix(heatMapName, resolution)
+        partHeatMaps = [updateHeatMapLevel(part, resolution, changes, images, savedMatrix is None) for part in parts]
+        newHeatMaps = [partNewHeatMap for partMatrix, partNewHeatMap in partHeatMaps if partNewHeatMap is not None]
+        newHeatMap = sum(newHeatMaps) if len(newHeatMaps) != 0 else None
+        if savedMatrix is None:
+            heatMapMatrix = sum(partMatrix for partMatrix, partNewHeatMap in partHeatMaps)
+            addHeatMapChange(changes, heatMapName, heatMapMatrix, savedMatrix, newHeatMap)
+        elif newHeatMap is not None:
+            heatMapMatrix = savedMatrix + newHeatMap
+            addHeatMapChange(changes, heatMapName, heatMapMatrix, savedMatrix, newHeatMap)
+        else:
+            heatMapMatrix = savedMatrix
+    if updated:
+        images.append((heatMapName, heatMapMatrix))
+    return heatMapMatrix, newHeatMap
+
+
+# Whether any of the PNGs of a heatmap is missing, such as the overviews of heatmaps rendered by older versions
+def heatMapImagesMissing(heatMapName):
+    for fileName in [heatMapName + ".png"] + [heatMapName + "_" + str(size) + ".png" for size in HEATMAPOVERVIEWSIZES]:
+        if not os.path.exists(fileName):
+            return True
+    return False
+
+
+# Return the heatmap levels of a channel of the heatmaps of a map for updateHeatMapLevel, with the new heatmaps of its
+# routes by (gamemode, layer, route id). The files of a channel are named after the heatmap followed by the channel.
+# In the "" channel of the heatmaps themselves the updated routes and the levels with missing PNGs are updated, in the
+# other channels only the routes with a new heatmap in the channel.
+def getHeatMapLevels(map, routeHeatMaps, channel=""):
+    def isUpdated(heatMapName, updated):
+        if channel == "":
+            return updated or heatMapImagesMissing(heatMapName)
+        return updated
+
+    mapHeatMapName = "./data/" + map.versionname + "/" + map.name + "/" + "combinedmovement"
+    gameModeLevels = []
+    for gameMode in map.gameModes:
+        gameModeHeatMapName = mapHeatMapName + "_" + gameMode.name
+        layerLevels = []
+        for layer in gameMode.layers:
+            layerHeatMapName = gameModeHeatMapName + "_" + layer.name
+            routeLevels = []
+            for route in layer.routes:
+                routeHeatMapName = layerHeatMapName + "_" + route.id + channel
+                routeHeatMap = routeHeatMaps.get((gameMode.name, layer.name, route.id))
+                routeLevels.append((routeHeatMapName, None, routeHeatMap, isUpdated(
+                    routeHeatMapName, route.updated if channel == "" else routeHeatMap is not None)))
+            layerLevels.append((layerHeatMapName + channel, routeLevels, None, isUpdated(
+                layerHeatMapName + channel, any(level[3] for level in routeLevels))))
+        gameModeLevels.append((gameModeHeatMapName + channel, layerLevels, None, isUpdated(
+            gameModeHeatMapName + channel, any(level[3] for level in layerLevels))))
+    return mapHeatMapName + channel, gameModeLevels, None, isUpdated(
+        mapHeatMapName + channel, any(level[3] for level in gameModeLevels))
+
+
+# Generate the heatmaps of a map from a (map, new heatmaps of its routes by channel and (gamemode, layer, route id),
+# tiles) tuple. The count matrices of the routes and of the layers, gamemodes and map are updated with the new heatmaps
+# only, so the work depends on the new rounds rather than on the number of routes of the map. The channels are updated
+# one after the other, rendering the PNGs of a channel once the changes to its count matrices are committed, with
+# tiles when tiles is set.
+def generateHeatMap(mapHeatMaps):
+    map, channelHeatMaps, tiles = mapHeatMaps
+    mapPath = "./data/" + map.versionname + "/" + map.name
+    if not os.path.exists(mapPath):
+        os.makedirs(mapPath)
+    recoverHeatMapChanges(mapPath)
+    resolution = findHeatMapResolution(map.name)
+    for channel in [""] + sorted(channel for channel in channelHeatMaps if channel != ""):
+        routeHeatMaps = {}
+        for route, heatMap in channelHeatMaps.get(channel, {}).iteritems():
+            if not isinstance(heatMap, np.ndarray):
+                heatMap = heatMapFromSparse(heatMap).astype(HEATMAPDTYPE)
+            routeHeatMaps[route] = heatMap
+        changes, images = [], []
+        updateHeatMapLevel(getHeatMapLevels(map, routeHeatMaps, channel), resolution, changes, images)
+        if len(changes) != 0:
+            commitHeatMapChanges(mapPath, changes)
+        for heatMapName, heatMapMatrix in images:
+            if isinstance(heatMapMatrix, basestring):
+                copyHeatMapImages(heatMapMatrix, heatMapName)
+            else:
+                renderHeatMapImages(heatMapMatrix, heatMapName, tiles)
     return map.name
 
 
@@ -93,6 +424,61 @@ def getDemoName(demoUrl):
     else:
         return os.path.basename(demoUrl)
 
+# Database with the names of the demos downloaded from every server, and file with the demo urls and
+# ETag/Last-Modified headers of the last response of every tracker link
+SEENDEMOSPATH = "./input/seendemos.db"
+INDEXCACHEPATH = "./input/indexcache.json"
+
+# Link targets of the anchors of a tracker index page
+INDEXLINK = re.compile(r"""<a\s[^>]*?href\s*=\s*["']?([^"'\s>]+)""", re.IGNORECASE)
+
+
+# Helper function to read a JSON file, returning default when it doesn't exist or can't be decoded
+def loadJSONFile(path, default):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+# Return the demo urls listed by a tracker link, which is a crawler JSON or an index page. The link is requested
+# with the ETag and Last-Modified date of its last response in indexCache, so an unchanged listing isn't sent and
+# parsed again but taken from indexCache.
+def getDemoUrls(downloader, link, indexCache):
+    cachedIndex = indexCache.get(link)
+    headers = {}
+    if cachedIndex is not None:
+        if cachedIndex['etag'] is not None:
+            headers['If-None-Match'] = cachedIndex['etag']
+        if cachedIndex['lastModified'] is not None:
+            headers['If-Modified-Since'] = cachedIndex['lastModified']
+    response = downloader.get(link, headers)
+    if response.status_code == 304 and cachedIndex is not None:
+        return cachedIndex['demoUrls']
+    if fnmatch(link, "*.json"):
+        demoUrls = [demoUrl for crawler in json2obj(response.content) for demoUrl in crawler.Trackers]
+    else:
+        demoUrls = [link + HTMLParser().unescape(href) for href in INDEXLINK.findall(response.text)
+                    if href.endswith('PRdemo')]
+    indexCache[link] = {'etag': response.headers.get('ETag'), 'lastModified': response.headers.get('Last-Modified'),
+                        'demoUrls': demoUrls}
+    return demoUrls
+
+
+# Number of demos that are downloaded at the same time, and at most from the same host
+DOWNLOADTHREADS = 8
+DOWNLOADSPERHOST = 2
+
+# Number of downloaded demos per parser process that may wait to be parsed before downloading pauses
+PARSEBACKLOG = 2
+
+# Number of times a failed request is retried, waiting DOWNLOADBACKOFF seconds before the first retry and twice as
+# long before every next one. Requests time out after DOWNLOADTIMEOUT seconds without data.
+DOWNLOADRETRIES = 3
+DOWNLOADBACKOFF = 1
+DOWNLOADTIMEOUT = 30
+
 # Helper functions to safely create new folders if it doesn't exist already
 def mkdir_p(path):
     try:
@@ -107,44 +493,138 @@ def safe_open_w(path):
     return open(path, 'w')
 
 
-# Helper function to return a null terminated string from pos in buffer
-def getString(stream):
-    tmp = ''
-    while True:
-        char = stream.read(1)
-        if char == '\0':
-            return tmp
-        tmp += char
-
-
-# Helper function to add to struct.unpack null terminated strings
-# Unpacks with null terminated strings when using "s".
-# Unpacks "vehicle" structs when using "v".
-# Returns a list of [value1,value2,value3...]
-def unpack(stream, fmt):
-    values = []
-
-    for i in range(0, len(fmt)):
-        if fmt[i] == 'v':
-            vehid = unpack(stream, "h")
-            if vehid >= 0:
-                (vehname, vehseat) = unpack(stream, "sb")
-                values.append((vehid, vehname, vehseat))
+# Precompiled structs for the fixed size parts of PRdemo messages. Compiling them once avoids re-parsing
+# the format string for every field of every message.
+MESSAGELENGTH = struct.Struct("<H")
+MESSAGETYPE = struct.Struct("<B")
+SERVERDETAILSHEAD = struct.Struct("<If")
+SERVERDETAILSPORTS = struct.Struct("<BHH")
+SERVERDETAILSLAYER = struct.Struct("<B")
+SERVERDETAILSTAIL = struct.Struct("<IHH")
+PLAYERUPDATEHEAD = struct.Struct("<HB")
+FLAGENTRY = struct.Struct("<HBHHHH")
+UINT8 = struct.Struct("<B")
+INT8 = struct.Struct("<b")
+UINT16 = struct.Struct("<H")
+INT16 = struct.Struct("<h")
+
+
+# Message types that runMessage decodes. Other messages are skipped without being loaded.
+DECODEDMESSAGES = frozenset([0x00, 0x10, 0x11, 0x12, 0x41, 0x52, 0x53, 0xf1])
+
+# Size of the compressed chunks read from a demo and the maximum size of the decompressed data made from them per step.
+STREAMCHUNKSIZE = 65536
+
+
+# Helper function to return a null terminated string at offset in buffer together with the offset after it.
+# Finds the terminator with a single search on the buffer instead of reading byte by byte.
+def getString(buffer, offset):
+    end = buffer.find('\0', offset)
+    if end == -1:
+        raise struct.error("unterminated string")
+    return buffer[offset:end], end + 1
+
+
+# Fields of the update player message in the order they appear, with the bit that flags their presence.
+# "s" is a null terminated string and "v" a vehicle.
+PLAYERFLAGS = [
+    ('team', 1, 'B'),
+    ('squad', 2, 'B'),
+    ('vehicle', 4, 'v'),
+    ('health', 8, 'b'),
+    ('score', 16, 'h'),
+    ('twscore', 32, 'h'),
+    ('kills', 64, 'h'),
+    ('deaths', 256, 'h'),
+    ('ping', 512, 'h'),
+    ('isalive', 2048, 'B'),
+    ('isjoining', 4096, 'B'),
+    ('pos', 8192, 'hhh'),
+    ('rot', 16384, 'h'),
+    ('kit', 32768, 's'),
+]
+POSITIONBIT = 8192
+# Bits of the fields the player group of a position depends on
+GROUPBITS = 1 | 4
+
+# Parse profiles of demoParser. "full" decodes every field of the update player messages, "heatmap" only the fields
+# needed for the heatmap and "stats" skips the update player messages entirely, leaving the demo without a heatmap.
+PARSEPROFILES = ["full", "heatmap", "stats"]
+
+# Update player fields decoded per parse profile, None meaning all of them.
+PROFILEPLAYERFIELDS = {
+    "full": None,
+    "heatmap": frozenset(['isalive', 'pos']),
+}
+
+# Cache of compiled update player layouts per set of decoded fields, keyed by the flags value of the update.
+playerUpdateLayouts = {}
+
+
+# Helper function to compile the layout of an update player entry with the given flags for a set of decoded fields,
+# None meaning all of them. Consecutive fixed size fields are merged into a single precompiled struct, in which fields
+# that aren't decoded are padding. The layout is a list of segments (kind, decoder, fields): kind 0 is a struct with a
+# list of (field, index, count) to map its values, kind 1 a string field, kind 2 a vehicle field and kind 3 a number
+# of bytes to skip. The field of kind 1 and 2 is None when it is only read to get past it.
+def getPlayerUpdateLayout(flags, wantedFields=None):
+    layouts = playerUpdateLayouts.setdefault(wantedFields, {})
+    layout = layouts.get(flags)
+    if layout is not None:
+        return layout
+    layout = []
+    fmt = ""
+    fields = []
+    valueCount = 0
+
+    def addStruct():
+        if len(fields) != 0:
+            layout.append((0, struct.Struct("<" + fmt), fields))
+        elif fmt != "":
+            layout.append((3, struct.calcsize("<" + fmt), None))
+
+    for field, bit, fieldFormat in PLAYERFLAGS:
+        if flags & bit:
+            wanted = wantedFields is None or field in wantedFields
+            if fieldFormat == 's' or fieldFormat == 'v':
+                addStruct()
+                fmt = ""
+                fields = []
+                valueCount = 0
+                layout.append((1 if fieldFormat == 's' else 2, None, field if wanted else None))
+            elif wanted:
+                fields.append((field, valueCount, len(fieldFormat)))
+                fmt += fieldFormat
+                valueCount += len(fieldFormat)
             else:
-                values.append((vehid))
+                fmt += str(struct.calcsize("<" + fieldFormat)) + "x"
+    addStruct()
+    layouts[flags] = layout
+    return layout
+
+
+# Number of positions demoParser collects before adding them to its heatmap in one go.
+POSITIONBATCHSIZE = 32768
+
+
+# Helper function to turn map positions into the cells of a heatmap with the given resolution, vectorized over a numpy
+# array of positions. A map spans 1024 * scale positions around its center in both directions.
+def heatMapCells(positions, scale, resolution):
+    if isinstance(scale, (int, long)):
+        return np.floor_divide(positions * resolution, 1024 * scale) + resolution / 2
+    return np.floor(positions * (resolution / (1024.0 * scale))).astype(np.int64) + resolution / 2
+
+
+# Helper function to decode a vehicle field at offset. Vehicle fields are a vehicle id, followed by the
+# vehicle name and seat when the id is valid. Returns the value together with the offset after it.
+def getVehicle(buffer, offset):
+    vehid = INT16.unpack_from(buffer, offset)[0]
+    offset += 2
+    if vehid >= 0:
+        vehname, offset = getString(buffer, offset)
+        vehseat = INT8.unpack_from(buffer, offset)[0]
+        return (vehid, vehname, vehseat), offset + 1
+    return vehid, offset
 
-        elif fmt[i] == 's':
-            string = getString(stream)
-            values.append(string)
-        else:
-            size = struct.calcsize(fmt[i])
-            try:
-                values.append(struct.unpack("<" + fmt[i], stream.read(size))[0])
-            except:
-                return -1;
-    if len(values) == 1:
-        return values[0]
-    return values
 
 # Helper function to through a folder and list all files
 def walkdir(folder):
@@ -172,26 +652,329 @@ def update_progress(currentCount,totalCount):
     sys.stdout.write(text)
     sys.stdout.flush()
 
-# Helper function that is used by multiprocessing to start a worker to parse a PRDemo
-def parseNewDemo(filepath):
-    parsedDemo = demoParser(filepath).getParsedDemo()
+# Helper function that is used by multiprocessing to start a worker to parse a PRDemo. With useCache the result is
+# taken from the demo cache when the demo was parsed before, and stored in it otherwise.
+def parseNewDemo(filepath, profile="full", useCache=False, channelTypes=()):
+    if useCache:
+        demoHash = fileHash(filepath)
+        parsedDemo = loadCachedDemo(demoHash, profile, channelTypes)
+        if parsedDemo is not None:
+            return parsedDemo
+    parser = demoParser(filepath, profile, channelTypes)
+    parsedDemo = parser.getParsedDemo()
+    if useCache:
+        saveCachedDemo(demoHash, parsedDemo, parser.heatMapSettings, parser.channelTypes)
+    return parsedDemo
+
+
+# Helper function that is used by multiprocessing to parse a PRDemo, returning the path of the demo with its result
+# An exception is returned instead of raised, so the parent gets a result for every demo it submitted.
+def parseDemoFile(demoFilePath, profile="full", useCache=False, channelTypes=()):
+    try:
+        return demoFilePath, sparseParsedDemo(parseNewDemo(demoFilePath, profile, useCache, channelTypes))
+    except Exception, e:
+        return demoFilePath, e
+
+# Path of the file with the display name and scale of every map
+MAPINFOPATH = "./input/maps.json"
+
+_mapInfo = None
+_mapInfoModified = None
+
+
+# Return the map information of /input/maps.json as a dict by map name, or None when it can't be read. The file is
+# only read again when it was modified, so a worker reads it once instead of once per demo.
+def getMapInfo():
+    global _mapInfo, _mapInfoModified
+    try:
+        modified = os.path.getmtime(MAPINFOPATH)
+    except OSError:
+        _mapInfo = _mapInfoModified = None
+        return None
+    if modified != _mapInfoModified:
+        try:
+            with open(MAPINFOPATH, 'r') as f:
+                _mapInfo = json.loads(f.read())
+        except (IOError, ValueError):
+            _mapInfo = None
+        _mapInfoModified = modified
+    return _mapInfo
+
+# Downloader of a worker process, created by parseDemoUrl
+_workerDownloader = None
+
+
+# Helper function that is used by multiprocessing to parse a demo while it is downloaded, without saving it to the
+# demos folder. With archiveFilePath the demo is also saved there. A failed download or parse is retried from the start.
+def parseDemoUrl(demoUrl, archiveFilePath=None, profile="full", useCache=False, channelTypes=()):
+    global _workerDownloader
+    if _workerDownloader is None:
+        _workerDownloader = DemoDownloader()
+    return sparseParsedDemo(_workerDownloader.retry(demoUrl, partial(streamDemo, demoUrl, archiveFilePath, profile,
+                                                                     useCache, channelTypes)))
+
+
+# Parse the response of a GET request to a demo url as it is received. With useCache the result is stored in the
+# demo cache by the hash of the received demo.
+def streamDemo(demoUrl, archiveFilePath, profile, useCache, channelTypes, session):
+    response = session.get(demoUrl, stream=True, timeout=DOWNLOADTIMEOUT)
+    try:
+        response.raise_for_status()
+        demoStream = DemoStream(response, archiveFilePath)
+        try:
+            parser = demoParser(demoStream, profile, channelTypes)
+            parsedDemo = parser.getParsedDemo()
+            demoStream.finish()
+        except:
+            demoStream.abort()
+            raise
+    finally:
+        response.close()
+    if useCache:
+        saveCachedDemo(demoStream.sha.hexdigest(), parsedDemo, parser.heatMapSettings, parser.channelTypes)
     return parsedDemo
 
 #Find the map scale found in /input/maps.json. Used for correctly aggragate positions of players
 #to heatmap data.
 def findScale(mapName):
     try:
-        with open("./input/maps.json", 'r') as f:
-            mapInfoData = f.read()
-            mapInfo = json2obj(mapInfoData)
-            if hasattr(mapInfo, mapName):
-                return getattr(mapInfo, mapName).scale
-            else:
-                return 0
-    except:
+        return getMapInfo()[mapName]['scale']
+    except (TypeError, KeyError):
         return 0
 
 
+# Return the name of the heatmap channel of a time slice of a round
+def timeSliceChannel(timeSlice):
+    return "_time" + str(timeSlice * HEATMAPTIMESLICE // 60)
+
+
+# Return the resolution of the heatmap count matrices of a map, from its "heatMapResolution" in /input/maps.json or
+# otherwise from HEATMAPRESOLUTIONS by its scale
+def findHeatMapResolution(mapName):
+    try:
+        resolution = getMapInfo()[mapName]['heatMapResolution']
+        if resolution >= HEATMAPIMAGESIZE and resolution & (resolution - 1) == 0:
+            return resolution
+    except (TypeError, KeyError):
+        pass
+    return HEATMAPRESOLUTIONS.get(findScale(mapName), HEATMAPIMAGESIZE)
+
+
+# Return the settings of /input/maps.json the heatmap of a demo of a map is made with, as (scale, resolution). Maps
+# without a scale get no heatmap, so their resolution is None.
+def heatMapSettings(mapName):
+    scale = findScale(mapName)
+    if scale == 0:
+        return 0, None
+    return scale, findHeatMapResolution(mapName)
+
+
+# Version of the results of demoParser. Increase it when a parser change changes its results, so the demo cache
+# parses demos again instead of returning results of the old parser.
+PARSERVERSION = 7
+
+# Folder of the demo cache, which stores the parse result of every demo by the SHA-1 of the demo file.
+DEMOCACHEPATH = "./cache"
+
+
+# Helper function to return the SHA-1 of the content of a file
+def fileHash(filepath):
+    sha = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(STREAMCHUNKSIZE)
+            if chunk == '':
+                return sha.hexdigest()
+            sha.update(chunk)
+
+
+# Helper functions to convert a heatmap between its dense matrix and a sparse (shape, indices, counts) form holding
+# only the flattened indices and counts of its non-empty cells.
+def heatMapToSparse(heatMap):
+    indices = np.flatnonzero(heatMap)
+    return heatMap.shape, indices.astype(np.uint32), heatMap.ravel()[indices].astype(np.uint32)
+
+
+def heatMapFromSparse(sparseHeatMap):
+    shape, indices, counts = sparseHeatMap
+    heatMap = np.zeros(shape=shape, dtype=int)
+    heatMap.ravel()[indices] = counts
+    return heatMap
+
+
+# Add a sparse heatmap to a dense heatmap of the same shape in place
+def addSparseHeatMap(heatMap, sparseHeatMap):
+    shape, indices, counts = sparseHeatMap
+    heatMap.ravel()[indices] += counts
+
+
+# Return the sum of two sparse heatmaps of the same shape as a sparse heatmap
+def mergeSparseHeatMaps(sparseHeatMap, otherSparseHeatMap):
+    indices, cells = np.unique(np.concatenate((sparseHeatMap[1], otherSparseHeatMap[1])), return_inverse=True)
+    counts = np.bincount(cells, weights=np.concatenate((sparseHeatMap[2], otherSparseHeatMap[2])))
+    return sparseHeatMap[0], indices.astype(np.uint32), counts.astype(np.uint32)
+
+
+# Replace the heatmap of a ParsedDemo by its sparse form before a worker returns it, so only the non-empty cells are
+# pickled to the parent instead of the whole matrix. The heatmap channels are sparse already.
+def sparseParsedDemo(parsedDemo):
+    if parsedDemo._heatMap is not None:
+        parsedDemo._heatMap = heatMapToSparse(parsedDemo._heatMap)
+    return parsedDemo
+
+
+def demoCacheFilePath(demoHash):
+    return DEMOCACHEPATH + "/" + demoHash + "_" + str(PARSERVERSION) + ".cache"
+
+
+# Return the cached ParsedDemo of the demo with the given hash, or None when it isn't cached by this parser version,
+# was cached without the heatmap the profile needs or its heatmap was made with other heatMapSettings of its map or
+# other heatmap channel types.
+def loadCachedDemo(demoHash, profile, channelTypes=()):
+    cacheFilePath = demoCacheFilePath(demoHash)
+    try:
+        with open(cacheFilePath, 'rb') as f:
+            fields, flags, sparseHeatMap, sparseHeatMapChannels, settings, cachedChannelTypes = cPickle.loads(
+                zlib.decompress(f.read()))
+    except Exception, e:
+        return None
+    if profile != "stats" and (sparseHeatMap is None or settings != heatMapSettings(fields.get('map')) or
+                               cachedChannelTypes != frozenset(channelTypes)):
+        return None
+    # Mark the entry as recently used for pruneDemoCache
+    os.utime(cacheFilePath, None)
+    parsedDemo = ParsedDemo()
+    parsedDemo.__dict__.update(fields)
+    parsedDemo.flags = [Flag(*flag) for flag in flags]
+    if profile != "stats":
+        parsedDemo._heatMap = heatMapFromSparse(sparseHeatMap)
+        parsedDemo._heatMapChannels = sparseHeatMapChannels
+    return parsedDemo
+
+
+# Store a ParsedDemo in the demo cache as a compressed pickle of its fields, flags, sparse heatmap and heatmap
+# channels, with the heatMapSettings of its map and the heatmap channel types the parser used. It is written to a
+# temporary file first so other workers never read a partial entry.
+def saveCachedDemo(demoHash, parsedDemo, settings, channelTypes):
+    fields = dict((key, value) for key, value in parsedDemo.__dict__.iteritems()
+                  if key not in ('flags', '_heatMap', '_heatMapChannels'))
+    flags = [(flag.cpid, flag.x, flag.y, flag.z, flag.radius) for flag in parsedDemo.flags]
+    if parsedDemo._heatMap is not None:
+        sparseHeatMap = heatMapToSparse(parsedDemo._heatMap)
+    else:
+        sparseHeatMap = None
+    data = zlib.compress(cPickle.dumps((fields, flags, sparseHeatMap, parsedDemo._heatMapChannels, settings,
+                                        channelTypes), cPickle.HIGHEST_PROTOCOL))
+    try:
+        mkdir_p(DEMOCACHEPATH)
+        cacheFilePath = demoCacheFilePath(demoHash)
+        with open(cacheFilePath + ".tmp" + str(os.getpid()), 'wb') as f:
+            f.write(data)
+        os.rename(cacheFilePath + ".tmp" + str(os.getpid()), cacheFilePath)
+    except (IOError, OSError), e:
+        pass
+
+
+# Remove demo cache entries of other parser versions, entries not used for more than maxAge days and then the least
+# recently used entries until the cache is no larger than maxSize megabytes.
+def pruneDemoCache(maxAge, maxSize):
+    if not os.path.isdir(DEMOCACHEPATH):
+        return
+    entries = []
+    oldestUse = time.time() - maxAge * 24 * 60 * 60
+    for filepath in walkdir(DEMOCACHEPATH):
+        fileStat = os.stat(filepath)
+        if not filepath.endswith("_" + str(PARSERVERSION) + ".cache") or fileStat.st_mtime < oldestUse:
+            os.remove(filepath)
+        else:
+            entries.append((fileStat.st_mtime, fileStat.st_size, filepath))
+    cacheSize = sum(size for lastUse, size, filepath in entries)
+    for lastUse, size, filepath in sorted(entries):
+        if cacheSize <= maxSize * 1024 * 1024:
+            break
+        os.remove(filepath)
+        cacheSize -= size
+
+
+# File in the data folder of a map that stores all of its rounds as columns, so a run can continue the statistics
+# without parsing statistics.json, which is only written for the website.
+ROUNDSTOREFILENAME = "rounds.npz"
+
+# Columns of the round store: one row of totals per route, one row per round in route order and one row per flag
+# in round order.
+ROUNDSTORETOTALS = np.dtype([('roundCount', 'i4'), ('timesPlayed', 'i8'), ('totalTicketsTeam1', 'i8'),
+                             ('totalTicketsTeam2', 'i8'), ('totalDuration', 'f8'), ('winsTeam1', 'i8'),
+                             ('winsTeam2', 'i8'), ('draws', 'i8')])
+ROUNDSTOREROUNDS = np.dtype([('date', 'i8'), ('duration', 'f8'), ('playerCount', 'i4'), ('ticketsTeam1', 'i4'),
+                             ('ticketsTeam2', 'i4'), ('flagCount', 'i4')])
+ROUNDSTOREFLAGS = np.dtype([('cpid', 'i4'), ('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('radius', 'i4')])
+
+
+def roundStoreFilePath(versionName, mapName):
+    return "./data/" + versionName + "/" + mapName + "/" + ROUNDSTOREFILENAME
+
+
+# Helper function to replace a file by another one, also on Windows where rename doesn't overwrite
+def replaceFile(sourcePath, targetPath):
+    try:
+        os.rename(sourcePath, targetPath)
+    except OSError:
+        os.remove(targetPath)
+        os.rename(sourcePath, targetPath)
+
+
+# Write the rounds and running sums of all routes of a map to its round store
+def saveRoundStore(versionName, mapName, map):
+    gameModes, layers, routeIds, totals, rounds, flags = [], [], [], [], [], []
+    for gameMode in map.gameModes:
+        for layer in gameMode.layers:
+            for route in layer.routes:
+                gameModes.append(gameMode.name)
+                layers.append(layer.name)
+                routeIds.append(route.id)
+                totals.append((len(route.roundsPlayed), route.timesPlayed, route.totalTicketsTeam1,
+                               route.totalTicketsTeam2, route.totalDuration, route.winsTeam1, route.winsTeam2,
+                               route.draws))
+                for parsedDemo in route.roundsPlayed:
+                    rounds.append((parsedDemo.date, parsedDemo.duration, parsedDemo.playerCount,
+                                   parsedDemo.ticketsTeam1, parsedDemo.ticketsTeam2, len(parsedDemo.flags)))
+                    flags.extend((flag.cpid, flag.x, flag.y, flag.z, flag.radius) for flag in parsedDemo.flags)
+    filePath = roundStoreFilePath(versionName, mapName)
+    mkdir_p(os.path.dirname(filePath))
+    with open(filePath + ".tmp", 'wb') as f:
+        np.savez(f, info=np.array([versionName, mapName], dtype='S'), gameModes=np.array(gameModes, dtype='S'),
+                 layers=np.array(layers, dtype='S'), routeIds=np.array(routeIds, dtype='S'),
+                 totals=np.array(totals, dtype=ROUNDSTORETOTALS), rounds=np.array(rounds, dtype=ROUNDSTOREROUNDS),
+                 flags=np.array(flags, dtype=ROUNDSTOREFLAGS))
+    replaceFile(filePath + ".tmp", filePath)
+
+
+# Read a round store. Returns the version and map name and a (gameMode, layer, route id, RoundTotals, StoredRounds)
+# tuple per route.
+def loadRoundStore(filePath):
+    with np.load(filePath) as store:
+        versionName, mapName = store['info'].tolist()
+        gameModes = store['gameModes'].tolist()
+        layers = store['layers'].tolist()
+        routeIds = store['routeIds'].tolist()
+        totals = store['totals'].tolist()
+        rounds = store['rounds']
+        flags = store['flags']
+    flagStarts = np.concatenate(([0], np.cumsum(rounds['flagCount'])))
+    routes = []
+    roundStart = 0
+    for gameMode, layer, routeId, routeTotals in zip(gameModes, layers, routeIds, totals):
+        roundEnd = roundStart + routeTotals[0]
+        roundTotals = RoundTotals()
+        (roundTotals.timesPlayed, roundTotals.totalTicketsTeam1, roundTotals.totalTicketsTeam2,
+         roundTotals.totalDuration, roundTotals.winsTeam1, roundTotals.winsTeam2, roundTotals.draws) = routeTotals[1:]
+        storedRounds = StoredRounds(versionName, mapName, gameMode, layer, rounds[roundStart:roundEnd],
+                                    flags[flagStarts[roundStart]:flagStarts[roundEnd]])
+        routes.append((gameMode, layer, routeId, roundTotals, storedRounds))
+        roundStart = roundEnd
+    return versionName, mapName, routes
+
+
 ###############################
 #           CLASSES           #
 ###############################
@@ -209,7 +992,7 @@ class Flag(object):
 class ParsedDemo(object):
 
     def __init__(self,version=0, date=0, map=0, gameMode=0, layer=0, duration=0, playerCount=0, ticketsTeam1=0, ticketsTeam2=0,
-                 flags=[],heatMap = None):
+                 flags=[],heatMap = None, heatMapChannels=None):
         self.version = version
         self.map = map
         self.date = date
@@ -220,9 +1003,13 @@ class ParsedDemo(object):
         self.ticketsTeam1 = ticketsTeam1
         self.ticketsTeam2 = ticketsTeam2
         self.flags = flags
-        self.heatMap = heatMap
+        # Left out of the statistics export, the heatmap and the sparse heatmaps of the channels by name are only
+        # carried from the parser to the HeatMapAccumulator
+        self._heatMap = heatMap
+        self._heatMapChannels = heatMapChannels
 
-    def setData(self, version, date, map, gameMode, layer, duration, playerCount, ticketsTeam1, ticketsTeam2, flags,heatMap):
+    def setData(self, version, date, map, gameMode, layer, duration, playerCount, ticketsTeam1, ticketsTeam2, flags,heatMap,
+                heatMapChannels):
         self.version = version
         self.date = date
         self.map = map
@@ -233,7 +1020,14 @@ class ParsedDemo(object):
         self.ticketsTeam1 = ticketsTeam1
         self.ticketsTeam2 = ticketsTeam2
         self.flags = flags
-        self.heatMap = heatMap
+        self._heatMap = heatMap
+        self._heatMapChannels = heatMapChannels
+
+    # Whether the demo was parsed completely and had enough players to count in the statistics
+    def isCounted(self):
+        return self.map != 0 and ((self.gameMode == "Co-Operative" and self.playerCount > 2) or (
+                self.gameMode != "Co-Operative" and self.gameMode != "Skirmish" and self.playerCount > 64) or (
+                                      self.gameMode == "Skirmish" and self.playerCount > 8))
 
     # TODO Implement SGID method
     # Create ID of flag route based on CPID list (placeholder until SGID is available to calculate route ID)
@@ -257,16 +1051,160 @@ class ServerList(object):
 
     # Write object to JSON string
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
+        return json.dumps(self, default=jsonFields,
                           sort_keys=True, indent=4)
 
 
 class Server(object):
 
-    def __init__(self,name,links,demos):
+    def __init__(self,name,links):
         self.name = name;
         self.links = links
-        self.demos = demos;
+
+
+# Downloads files over a pooled requests.Session per host, with at most DOWNLOADSPERHOST requests to a host at the same
+# time. Failed requests are retried with backoff and downloads resume a partial file with an HTTP Range request.
+class DemoDownloader(object):
+
+    def __init__(self, perHost=DOWNLOADSPERHOST):
+        self.perHost = perHost
+        self._sessions = {}
+        self._hostSlots = {}
+        self._lock = threading.Lock()
+
+    # Return the session of the host of an url and the semaphore limiting the requests to it
+    def getSession(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.perHost)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+                self._hostSlots[host] = threading.Semaphore(self.perHost)
+            return self._sessions[host], self._hostSlots[host]
+
+    # Run request(session) for the host of an url, retrying it with backoff when it fails
+    def retry(self, url, request):
+        session, hostSlots = self.getSession(url)
+        for attempt in range(DOWNLOADRETRIES + 1):
+            try:
+                with hostSlots:
+                    return request(session)
+            except (requests.RequestException, requests.packages.urllib3.exceptions.HTTPError, IOError), e:
+                # Client errors such as a missing file don't go away by retrying
+                response = getattr(e, 'response', None)
+                if attempt == DOWNLOADRETRIES or (response is not None and 400 <= response.status_code < 500 and
+                                                  response.status_code not in (408, 429)):
+                    raise
+            time.sleep(DOWNLOADBACKOFF * 2 ** attempt)
+
+    # Return the response of a GET request to an url
+    def get(self, url, headers=None):
+        def request(session):
+            response = session.get(url, headers=headers, timeout=DOWNLOADTIMEOUT)
+            response.raise_for_status()
+            return response
+        return self.retry(url, request)
+
+    # Download an url to a file. The data is written to filePath.part, which is renamed to filePath when it is
+    # complete. Returns whether the download succeeded.
+    def download(self, url, filePath):
+        partPath = filePath + ".part"
+        try:
+            self.retry(url, partial(self.downloadPart, url, partPath))
+            replaceFile(partPath, filePath)
+            return True
+        except (requests.RequestException, IOError, OSError), e:
+            return False
+
+    # Download the rest of an url to a partial file, starting over when the server doesn't return the requested range
+    def downloadPart(self, url, partPath, session):
+        offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        headers = {'Range': 'bytes=' + str(offset) + '-'} if offset > 0 else {}
+        response = session.get(url, headers=headers, stream=True, timeout=DOWNLOADTIMEOUT)
+        try:
+            if offset > 0 and response.status_code == 416:
+                # The partial file already holds the whole file
+                return
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            expectedSize = response.headers.get('Content-Length')
+            size = 0
+            with open(partPath, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in response.iter_content(STREAMCHUNKSIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            if expectedSize is not None and size < int(expectedSize):
+                raise IOError("Download of " + url + " ended early")
+        finally:
+            response.close()
+
+
+# File object reading a demo from a streamed response. It hashes the data that is read and copies it to
+# archiveFilePath.part, which is renamed to archiveFilePath by finish.
+class DemoStream(object):
+
+    def __init__(self, response, archiveFilePath=None):
+        self.raw = response.raw
+        self.raw.decode_content = True
+        # The size of the demo can only be checked when it isn't sent compressed
+        if 'Content-Encoding' in response.headers:
+            self.expectedSize = None
+        else:
+            self.expectedSize = response.headers.get('Content-Length')
+        self.sha = hashlib.sha1()
+        self.archiveFilePath = archiveFilePath
+        if archiveFilePath is not None:
+            self.archive = open(archiveFilePath + ".part", 'wb')
+        else:
+            self.archive = None
+
+    def read(self, size):
+        data = self.raw.read(size)
+        self.sha.update(data)
+        if self.archive is not None:
+            self.archive.write(data)
+        return data
+
+    # Read the rest of the demo the parser didn't need, check that all of it was received and complete the archive
+    def finish(self):
+        while self.read(STREAMCHUNKSIZE) != '':
+            pass
+        if self.expectedSize is not None and self.raw.tell() < int(self.expectedSize):
+            raise IOError("Download ended early")
+        if self.archive is not None:
+            self.archive.close()
+            replaceFile(self.archiveFilePath + ".part", self.archiveFilePath)
+
+    def abort(self):
+        if self.archive is not None:
+            self.archive.close()
+            os.remove(self.archiveFilePath + ".part")
+
+
+# Names of the demos downloaded from every server. They are kept in an indexed sqlite table that is only added to, so
+# checking or adding a demo doesn't get slower as more demos are downloaded.
+class SeenDemos(object):
+
+    def __init__(self, path=SEENDEMOSPATH):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS seenDemos (server TEXT NOT NULL, demo TEXT NOT NULL, "
+                                "PRIMARY KEY (server, demo)) WITHOUT ROWID")
+
+    def contains(self, serverName, demoName):
+        return self.connection.execute("SELECT 1 FROM seenDemos WHERE server = ? AND demo = ?",
+                                       (serverName, demoName)).fetchone() is not None
+
+    def add(self, serverName, demoNames):
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO seenDemos VALUES (?, ?)",
+                                        ((serverName, demoName) for demoName in demoNames))
+
+    def close(self):
+        self.connection.close()
 
 
 class MapList(object):
@@ -277,7 +1215,7 @@ class MapList(object):
 
     # Write object to JSON string
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
+        return json.dumps(self, default=jsonFields,
                           sort_keys=True, indent=4)
 
 
@@ -286,6 +1224,7 @@ class Map(object):
     def __init__(self, name):
         self.name = name
         self.gameModes = []
+        self._gameModeIndex = {}
         self.timesPlayed = 0
         self.averageDuration = 0
         self.averageTicketsTeam1 = 0
@@ -295,9 +1234,18 @@ class Map(object):
         self.draws = 0
         self.versions =  []
 
+    # Return the gamemode with the given name, adding it if it doesn't exist yet
+    def getGameMode(self, name):
+        gameMode = self._gameModeIndex.get(name)
+        if gameMode is None:
+            gameMode = GameMode(name)
+            self.gameModes.append(gameMode)
+            self._gameModeIndex[name] = gameMode
+        return gameMode
+
     # Write object to JSON string
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__,
+        return json.dumps(self, default=jsonFields,
                           sort_keys=True, indent=4)
 
 
@@ -306,6 +1254,7 @@ class GameMode(object):
     def __init__(self, name):
         self.name = name
         self.layers = []
+        self._layerIndex = {}
         self.timesPlayed = 0
         self.averageDuration = 0
         self.averageTicketsTeam1 = 0
@@ -314,12 +1263,22 @@ class GameMode(object):
         self.winsTeam2 = 0
         self.draws = 0
 
+    # Return the layer with the given name, adding it if it doesn't exist yet
+    def getLayer(self, name):
+        layer = self._layerIndex.get(name)
+        if layer is None:
+            layer = Layer(name)
+            self.layers.append(layer)
+            self._layerIndex[name] = layer
+        return layer
+
 
 class Layer(object):
 
     def __init__(self, name):
         self.name = name
         self.routes = []
+        self._routeIndex = {}
         self.timesPlayed = 0
         self.averageDuration = 0
         self.averageTicketsTeam1 = 0
@@ -328,66 +1287,273 @@ class Layer(object):
         self.winsTeam2 = 0
         self.draws = 0
 
-class Route(object):
+    # Return the route with the given id, adding it if it doesn't exist yet
+    def getRoute(self, id, updated):
+        route = self._routeIndex.get(id)
+        if route is None:
+            route = Route(id, updated)
+            self.routes.append(route)
+            self._routeIndex[id] = route
+        return route
+
+# Running sums of the rounds of a route, or of the routes of a layer, gamemode or map.
+class RoundTotals(object):
+
+    def __init__(self):
+        self.timesPlayed = 0
+        self.totalTicketsTeam1 = 0
+        self.totalTicketsTeam2 = 0
+        self.totalDuration = 0
+        self.winsTeam1 = 0
+        self.winsTeam2 = 0
+        self.draws = 0
+
+    def add(self, totals):
+        self.timesPlayed += totals.timesPlayed
+        self.totalTicketsTeam1 += totals.totalTicketsTeam1
+        self.totalTicketsTeam2 += totals.totalTicketsTeam2
+        self.totalDuration += totals.totalDuration
+        self.winsTeam1 += totals.winsTeam1
+        self.winsTeam2 += totals.winsTeam2
+        self.draws += totals.draws
+
+    # Set times played, wins, draws and averages of a Map, GameMode, Layer or Route from the sums
+    def setStatistics(self, target):
+        target.timesPlayed = self.timesPlayed
+        target.winsTeam1 = self.winsTeam1
+        target.winsTeam2 = self.winsTeam2
+        target.draws = self.draws
+        if self.timesPlayed != 0:
+            target.averageTicketsTeam1 = self.totalTicketsTeam1 / self.timesPlayed
+            target.averageTicketsTeam2 = self.totalTicketsTeam2 / self.timesPlayed
+            target.averageDuration = self.totalDuration / self.timesPlayed
+
+
+class Route(RoundTotals):
 
     def __init__(self, id, updated):
+        RoundTotals.__init__(self)
         self.id = id
         self.roundsPlayed = []
-        self.timesPlayed = 0
         self.averageDuration = 0
         self.averageTicketsTeam1 = 0
         self.averageTicketsTeam2 = 0
-        self.winsTeam1 = 0
-        self.winsTeam2 = 0
-        self.draws = 0
         self.heatMap = 0
         self.updated = updated
+        # Number of rounds at the start of roundsPlayed that are counted in the running sums
+        self.countedRounds = 0
+        self._storedRounds = None
+
+    # Add the rounds played that aren't counted yet to the running sums. Returns whether there were any.
+    def countNewRounds(self):
+        newRounds = self.roundsPlayed[self.countedRounds:]
+        for parsedDemo in newRounds:
+            if parsedDemo.ticketsTeam1 > parsedDemo.ticketsTeam2:
+                self.winsTeam1 += 1
+            elif parsedDemo.ticketsTeam2 > parsedDemo.ticketsTeam1:
+                self.winsTeam2 += 1
+            else:
+                self.draws += 1
+            self.totalTicketsTeam1 += parsedDemo.ticketsTeam1
+            self.totalTicketsTeam2 += parsedDemo.ticketsTeam2
+            self.totalDuration += parsedDemo.duration
+        self.timesPlayed += len(newRounds)
+        self.countedRounds = len(self.roundsPlayed)
+        return len(newRounds) != 0
+
+    # Take over the running sums of an imported route, which count all of its rounds that are in roundsPlayed
+    def importTotals(self, importedRoute):
+        self.timesPlayed = importedRoute.timesPlayed
+        self.totalTicketsTeam1 = importedRoute.totalTicketsTeam1
+        self.totalTicketsTeam2 = importedRoute.totalTicketsTeam2
+        self.totalDuration = importedRoute.totalDuration
+        self.winsTeam1 = importedRoute.winsTeam1
+        self.winsTeam2 = importedRoute.winsTeam2
+        self.draws = importedRoute.draws
+        self.countedRounds = len(self.roundsPlayed)
+
+    # Keep the rounds of the route from its round store aside, taking over the running sums that count them
+    def importStoredRounds(self, storedRounds, totals):
+        self._storedRounds = storedRounds
+        self.importTotals(totals)
+
+    # Put the rounds kept aside by importStoredRounds in front of the rounds played, for the statistics export
+    def loadStoredRounds(self):
+        if self._storedRounds is not None:
+            storedRounds = self._storedRounds.getParsedDemos()
+            self.roundsPlayed[:0] = storedRounds
+            self.countedRounds += len(storedRounds)
+            self._storedRounds = None
+
+
+# Rounds of a route read from a round store, which are only turned into ParsedDemo objects when they are needed
+class StoredRounds(object):
+
+    def __init__(self, version, map, gameMode, layer, rounds, flags):
+        self.version = version
+        self.map = map
+        self.gameMode = gameMode
+        self.layer = layer
+        self.rounds = rounds
+        self.flags = flags
+
+    def getParsedDemos(self):
+        parsedDemos = []
+        flags = [Flag(*flag) for flag in self.flags.tolist()]
+        flagStart = 0
+        for date, duration, playerCount, ticketsTeam1, ticketsTeam2, flagCount in self.rounds.tolist():
+            parsedDemo = ParsedDemo(self.version, date, self.map, self.gameMode, self.layer, duration, playerCount,
+                                    ticketsTeam1, ticketsTeam2, flags[flagStart:flagStart + flagCount])
+            parsedDemo.completed = True
+            parsedDemos.append(parsedDemo)
+            flagStart += flagCount
+        return parsedDemos
+
+# Counts of the cells of a heatmap that are added in batches, kept in the sparse (shape, indices, counts) form. The
+# batches are only merged once they hold more cells than a HEATMAPSPARSESHARE of the heatmap and than the merged
+# counts, so merging stays cheap and memory use stays below that of the dense matrix of most heatmaps.
+class SparseHeatMapCounter(object):
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.batches = []
+        # Cells of the merged counts and of the batches added after them
+        self.mergedCells = 0
+        self.batchCells = 0
+        self.maxBatchCells = int(np.prod(shape) * HEATMAPSPARSESHARE)
+
+    # Add the counts of a batch of distinct flattened cell indices
+    def add(self, indices, counts):
+        self.batches.append((indices.astype(np.uint32), counts.astype(np.uint32)))
+        self.batchCells += len(indices)
+        if self.batchCells > max(self.maxBatchCells, self.mergedCells):
+            self.merge()
+
+    def merge(self):
+        if len(self.batches) > 1:
+            indices, cells = np.unique(np.concatenate([batch[0] for batch in self.batches]), return_inverse=True)
+            counts = np.bincount(cells, weights=np.concatenate([batch[1] for batch in self.batches]))
+            self.batches = [(indices.astype(np.uint32), counts.astype(np.uint32))]
+        self.mergedCells = sum(len(batch[0]) for batch in self.batches)
+        self.batchCells = 0
+
+    # Return the sum of the batches as a sparse heatmap
+    def toSparse(self):
+        self.merge()
+        if len(self.batches) == 0:
+            return self.shape, np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+        return (self.shape,) + self.batches[0]
+
+
+# Sums of the heatmaps of the new rounds by (version, map, gamemode, layer, route id), in the resolution of the map.
+# Demos are added as they are parsed, so the heatmaps held at any time depend on the number of routes rather than the
+# number of demos. The sums are added to the saved heatmap of every route by generateHeatMap.
+class HeatMapAccumulator(object):
+
+    def __init__(self):
+        self.heatMaps = {}
+        # Sums of the heatmap channels by (route key, channel), kept sparse until they fill HEATMAPSPARSESHARE of
+        # their cells
+        self.channelHeatMaps = {}
+
+    # Add the sparse heatmap of a parsed demo to the sum of its route and drop it from the demo. Heatmaps in another
+    # resolution, such as cached ones from before the resolution of the map was changed, are resized first.
+    def add(self, parsedDemo):
+        route = (parsedDemo.version, parsedDemo.map, parsedDemo.gameMode, parsedDemo.layer, parsedDemo.getFlagId())
+        if route not in self.heatMaps:
+            resolution = findHeatMapResolution(parsedDemo.map)
+            self.heatMaps[route] = np.zeros(shape=(resolution, resolution), dtype=HEATMAPDTYPE)
+        heatMap = self.heatMaps[route]
+        if parsedDemo._heatMap[0] == heatMap.shape:
+            addSparseHeatMap(heatMap, parsedDemo._heatMap)
+        else:
+            heatMap += resizeHeatMap(heatMapFromSparse(parsedDemo._heatMap), heatMap.shape[0]).astype(HEATMAPDTYPE)
+        for channel, sparseHeatMap in parsedDemo._heatMapChannels.iteritems():
+            if sparseHeatMap[0] != heatMap.shape:
+                sparseHeatMap = heatMapToSparse(resizeHeatMap(heatMapFromSparse(sparseHeatMap), heatMap.shape[0]))
+            channelHeatMap = self.channelHeatMaps.get((route, channel))
+            if channelHeatMap is None:
+                channelHeatMap = sparseHeatMap
+            elif isinstance(channelHeatMap, np.ndarray):
+                addSparseHeatMap(channelHeatMap, sparseHeatMap)
+            else:
+                channelHeatMap = mergeSparseHeatMaps(channelHeatMap, sparseHeatMap)
+                if len(channelHeatMap[1]) > heatMap.size * HEATMAPSPARSESHARE:
+                    channelHeatMap = heatMapFromSparse(channelHeatMap).astype(HEATMAPDTYPE)
+            self.channelHeatMaps[(route, channel)] = channelHeatMap
+        parsedDemo._heatMap = parsedDemo._heatMapChannels = None
+
+    # Return the sums of the routes of a map by channel and (gamemode, layer, route id). The sums of the routes
+    # themselves are the "" channel, the sums of the other channels can still be sparse.
+    def getMapHeatMaps(self, versionName, mapName):
+        mapHeatMaps = {"": dict((route[2:], heatMap) for route, heatMap in self.heatMaps.iteritems()
+                                if route[:2] == (versionName, mapName))}
+        for (route, channel), heatMap in self.channelHeatMaps.iteritems():
+            if route[:2] == (versionName, mapName):
+                mapHeatMaps.setdefault(channel, {})[route[2:]] = heatMap
+        return mapHeatMaps
 
 class Player:
     def __init__(self):
         self.isalive = 0
+        self.team = 0
+        self.vehicle = -1
+        self.group = HEATMAPNOTEAMGROUP
 
     def __setitem__(self, key, value):
         self.__dict__[key] = value
 
 # Parse .PRdemo file
+# Parses the demo at a path, or read from a file object such as a DemoStream
+# channelTypes are the HEATMAPCHANNELTYPES of the heatmap channels to collect next to the heatmap of the round
 class demoParser:
-    def __init__(self, filename):
-        compressedFile = open(filename, 'rb')
-        compressedBuffer = compressedFile.read()
-        compressedFile.close()
-        # Try to decompress or assume its not compressed if it fails
-        try:
-            buffer = zlib.decompress(compressedBuffer)
-        except:
-            buffer = compressedBuffer
-
-        self.stream = cStringIO.StringIO(buffer)
-        self.length = len(buffer)
+    def __init__(self, filename, profile="full", channelTypes=()):
+        if profile not in PARSEPROFILES:
+            raise ValueError("Unknown parse profile: " + str(profile))
+        self.profile = profile
+        self.channelTypes = frozenset(channelTypes)
+        # Update player fields to decode, with the fields of the player groups when there are channels of them
+        self.playerFields = PROFILEPLAYERFIELDS.get(profile)
+        self.playerGroups = False
+        for channelType in self.channelTypes:
+            if channelType in HEATMAPCHANNELPLAYERFIELDS:
+                self.playerGroups = True
+                if self.playerFields is not None:
+                    self.playerFields = self.playerFields | HEATMAPCHANNELPLAYERFIELDS[channelType]
+        # Set once the map scale is known, update player messages are only decoded when there is a heatmap to make.
+        self.decodePlayerUpdates = False
+        # The demo is decompressed while it is parsed. Only the message being decoded and at most one chunk of
+        # decompressed data are held in the buffer, which is walked by offset and decoded in place.
+        openedFile = isinstance(filename, basestring)
+        if openedFile:
+            self.file = open(filename, 'rb')
+        else:
+            self.file = filename
+        self.decompressor = zlib.decompressobj()
+        self.firstChunk = True
+        self.buffer = ''
+        self.offset = 0
 
         self.playerCount = 0
         self.timePlayed = 0
         self.flags = []
         self.parsedDemo = ParsedDemo()
         self.scale = 0
+        self.resolution = HEATMAPIMAGESIZE
+        # heatMapSettings of the map, set with the scale and resolution once the map is known
+        self.heatMapSettings = heatMapSettings(None)
         self.playerDict = {}
-        self.PLAYERFLAGS = [
-            ('team', 1, 'B'),
-            ('squad', 2, 'B'),
-            ('vehicle', 4, 'v'),
-            ('health', 8, 'b'),
-            ('score', 16, 'h'),
-            ('twscore', 32, 'h'),
-            ('kills', 64, 'h'),
-            ('deaths', 256, 'h'),
-            ('ping', 512, 'h'),
-            ('isalive', 2048, 'B'),
-            ('isjoining', 4096, 'B'),
-            ('pos', 8192, 'hhh'),
-            ('rot', 16384, 'h'),
-            ('kit', 32768, 's'),
-        ]
-        self.heatMap = np.zeros(shape=(512,512))
+        self.heatMap = np.zeros(shape=(self.resolution, self.resolution), dtype=np.uint32)
+        # Sparse heatmaps of the time slices of the round that have any positions, by time slice
+        self.timeSlices = "time" in self.channelTypes
+        self.timeSlice = 0
+        self.timeHeatMaps = {}
+        # Sparse heatmaps of the player groups stacked in one matrix, created with the first position of the round
+        self.groupHeatMaps = None
+        # Positions of alive players (x, z and player group after each other) waiting to be added to the heatmaps by
+        # flushPositions
+        self.positions = array.array('h', [0]) * (3 * POSITIONBATCHSIZE)
+        self.positionCount = 0
         timeoutindex = 0
         # parse the first few until serverDetails one to get map info
         while self.runMessage() != 0x00:
@@ -396,12 +1562,31 @@ class demoParser:
             timeoutindex += 1
             pass
         self.runToEnd()
+        if openedFile:
+            self.file.close()
+        self.flushPositions()
 
         # create ParsedDemo object and set it to complete if it was able to get all data
+        if self.profile != "stats":
+            heatMap = self.heatMap.astype(int)
+            heatMapChannels = {}
+            for timeSlice, timeHeatMap in self.timeHeatMaps.iteritems():
+                heatMapChannels[timeSliceChannel(timeSlice)] = timeHeatMap.toSparse()
+            if self.groupHeatMaps is not None:
+                shape, indices, counts = self.groupHeatMaps.toSparse()
+                groups, cells = np.divmod(indices, heatMap.size)
+                for channel, channelType, channelGroups in HEATMAPGROUPCHANNELS:
+                    inChannel = np.in1d(groups, channelGroups)
+                    if channelType in self.channelTypes and inChannel.any():
+                        channelCells, cellIndex = np.unique(cells[inChannel], return_inverse=True)
+                        heatMapChannels[channel] = (heatMap.shape, channelCells.astype(np.uint32), np.bincount(
+                            cellIndex, weights=counts[inChannel]).astype(np.uint32))
+        else:
+            heatMap = heatMapChannels = None
         try:
             self.parsedDemo.setData(self.version, self.date, self.mapName, self.mapGamemode, self.mapLayer, self.timePlayed / 60,
                                     self.playerCount,
-                                    self.ticket1, self.ticket2, self.flags,self.heatMap.astype(int))
+                                    self.ticket1, self.ticket2, self.flags, heatMap, heatMapChannels)
             self.parsedDemo.completed = True
         except Exception, e:
             pass
@@ -409,29 +1594,137 @@ class demoParser:
     def getParsedDemo(self):
         return self.parsedDemo
 
+    # Return the next chunk of decompressed demo data, or an empty string at the end of the demo.
+    # Try to decompress the first chunk or assume the demo is not compressed if it fails.
+    def readChunk(self):
+        if self.decompressor is None:
+            return self.file.read(STREAMCHUNKSIZE)
+        compressedChunk = self.decompressor.unconsumed_tail
+        if compressedChunk == '':
+            compressedChunk = self.file.read(STREAMCHUNKSIZE)
+            if compressedChunk == '':
+                return self.decompressor.flush()
+        try:
+            chunk = self.decompressor.decompress(compressedChunk, STREAMCHUNKSIZE)
+        except zlib.error:
+            if self.firstChunk:
+                chunk = compressedChunk
+                self.decompressor = None
+            else:
+                chunk = ''
+        self.firstChunk = False
+        return chunk
+
+    # Make sure size bytes from the offset are in the buffer if the demo has them, reading more of it when needed.
+    # The part of the buffer before the offset is dropped. An offset past the end of the buffer is a skipped message
+    # of which the remaining bytes are thrown away as they are read.
+    def fillBuffer(self, size):
+        available = len(self.buffer) - self.offset
+        if available >= size:
+            return
+        if available > 0:
+            chunks = [self.buffer[self.offset:]]
+            skip = 0
+        else:
+            chunks = []
+            skip = -available
+            available = 0
+        while available < size:
+            chunk = self.readChunk()
+            if chunk == '':
+                break
+            if skip != 0:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            chunks.append(chunk)
+            available += len(chunk)
+        self.buffer = ''.join(chunks)
+        self.offset = 0
+
+    # Add the collected positions to the heatmap, to the heatmap of the current time slice and to the heatmaps of their
+    # player groups. Positions outside the map are dropped and the cells of the batch are counted once over their
+    # flattened indices, so adding them doesn't depend on the size of the heatmaps.
+    def flushPositions(self):
+        if self.positionCount == 0:
+            return
+        positions = np.frombuffer(self.positions, dtype=np.int16, count=self.positionCount).astype(np.int64)
+        self.positionCount = 0
+        xPositions = positions[0::3]
+        zPositions = positions[1::3]
+        bound = 256 * self.scale * 2
+        inside = (xPositions < bound) & (xPositions > -bound) & (zPositions < bound) & (zPositions > -bound)
+        x = heatMapCells(xPositions[inside], self.scale, self.resolution)
+        y = heatMapCells(-zPositions[inside], self.scale, self.resolution)
+        cells = x * self.resolution + y
+        batchCells, batchCounts = np.unique(cells, return_counts=True)
+        self.heatMap.reshape(-1)[batchCells] += batchCounts.astype(np.uint32)
+        if self.timeSlices:
+            if self.timeSlice not in self.timeHeatMaps:
+                self.timeHeatMaps[self.timeSlice] = SparseHeatMapCounter(self.heatMap.shape)
+            self.timeHeatMaps[self.timeSlice].add(batchCells, batchCounts)
+        if self.playerGroups:
+            if self.groupHeatMaps is None:
+                self.groupHeatMaps = SparseHeatMapCounter((HEATMAPGROUPS,) + self.heatMap.shape)
+            self.groupHeatMaps.add(*np.unique(positions[2::3][inside] * self.heatMap.size + cells, return_counts=True))
+
     #Find the next message and analyze it.
     def runMessage(self):
+        # Load the message length and type
+        if len(self.buffer) - self.offset < 3:
+            self.fillBuffer(3)
+        buffer = self.buffer
+        offset = self.offset
         # Check if end of file
-        tmp = self.stream.read(2)
-        if len(tmp) != 2:
+        if offset + 2 > len(buffer):
             return 0x99
         # Get 2 bytes of message length
-        messageLength = struct.unpack("H", tmp)[0]
-        startPos = self.stream.tell()
+        messageLength = MESSAGELENGTH.unpack_from(buffer, offset)[0]
         try:
-            messageType = struct.unpack("B", self.stream.read(1))[0]
+            messageType = MESSAGETYPE.unpack_from(buffer, offset + 2)[0]
         except Exception, e:
             return 0x99
+        # Load the rest of the message if it is decoded below
+        if offset + 2 + messageLength > len(buffer) and messageType in DECODEDMESSAGES and \
+                (messageType != 0x10 or self.decodePlayerUpdates):
+            self.fillBuffer(2 + messageLength)
+            buffer = self.buffer
+            offset = self.offset
+        offset += 2
+        endPos = offset + messageLength
+        # Skip to the next message up front, the cases below only read within this one.
+        self.offset = endPos
+        offset += 1
 
         if messageType == 0x00:  # server details
-            values = unpack(self.stream, "IfssBHHssBssIHH")
-            if values == -1:
+            try:
+                offset += SERVERDETAILSHEAD.size
+                serverName, offset = getString(buffer, offset)
+                versionString, offset = getString(buffer, offset)
+                offset += SERVERDETAILSPORTS.size
+                mapName, offset = getString(buffer, offset)
+                gamemode, offset = getString(buffer, offset)
+                layer = SERVERDETAILSLAYER.unpack_from(buffer, offset)[0]
+                offset += SERVERDETAILSLAYER.size
+                ignored, offset = getString(buffer, offset)
+                ignored, offset = getString(buffer, offset)
+                date = SERVERDETAILSTAIL.unpack_from(buffer, offset)[0]
+            except struct.error:
                 return 0x99
-            version = values[3].split(']')[0].split(' ')
+            version = versionString.split(']')[0].split(' ')
             self.version = version[1][:-2]
-            self.mapName = values[7]
-            self.scale = findScale(self.mapName)
-            gamemode = values[8]
+            self.mapName = mapName
+            self.flushPositions()
+            self.heatMapSettings = heatMapSettings(self.mapName)
+            self.scale = self.heatMapSettings[0]
+            self.decodePlayerUpdates = self.scale != 0 and self.profile != "stats"
+            if self.decodePlayerUpdates:
+                self.resolution = self.heatMapSettings[1]
+                self.heatMap = np.zeros(shape=(self.resolution, self.resolution), dtype=np.uint32)
+                self.timeHeatMaps = {}
+                self.groupHeatMaps = None
             if gamemode == "gpm_cq":
                 self.mapGamemode = "Advance & Secure"
             elif gamemode == "gpm_insurgency":
@@ -445,86 +1738,141 @@ class demoParser:
             elif gamemode == "gpm_coop":
                 self.mapGamemode = "Co-Operative"
             else:
-                self.mapGamemode = values[8]
-            self.mapLayer = "Layer " + str(values[9])
-            self.date = values[12]
+                self.mapGamemode = gamemode
+            self.mapLayer = "Layer " + str(layer)
+            self.date = date
 
         elif messageType == 0x52:  # tickets team 1
-            while self.stream.tell() - startPos != messageLength:
-                values = unpack(self.stream, "H")
-                if values == -1:
+            while offset != endPos:
+                try:
+                    values = UINT16.unpack_from(buffer, offset)[0]
+                except struct.error:
                     return 0x99
+                offset += 2
                 if values < 9000:
                     self.ticket1 = values
                 else:
                     self.ticket1 = 0
 
         elif messageType == 0x53:  # tickets team 2
-            while self.stream.tell() - startPos != messageLength:
-                values = unpack(self.stream, "H")
-                if values == -1:
+            while offset != endPos:
+                try:
+                    values = UINT16.unpack_from(buffer, offset)[0]
+                except struct.error:
                     return 0x99
+                offset += 2
                 if values < 9000:
                     self.ticket2 = values
                 else:
                     self.ticket2 = 0
 
         elif messageType == 0xf1:  # tick
-            while self.stream.tell() - startPos != messageLength:
-                values = unpack(self.stream, "B")
-                if values == -1:
-                    return 0x99
-                self.timePlayed = self.timePlayed + values * 0.04
-
-        elif messageType == 0x10 and self.scale != 0:  # update player
-            while self.stream.tell() - startPos != messageLength:
-                flags = unpack(self.stream, "H")
+            while offset != endPos:
                 try:
-                    p = self.playerDict[unpack(self.stream, "B")]
-                    for tuple in self.PLAYERFLAGS:
-                        field, bit, fmt = tuple
-                        if flags & bit:
-                            p[field] = unpack(self.stream, fmt)
-                            if field == "pos":
-                                if p.isalive:
-                                    if p.pos[0] < 256 * self.scale * 2 and p.pos[0] > -256 * self.scale * 2 and \
-                                            p.pos[2] < 256 * self.scale * 2 and p.pos[2] > -256 * self.scale * 2:
-                                        x = int(round(p.pos[0] / (self.scale * 4) + 128))
-                                        y = int(round(p.pos[2] / (self.scale * -4) + 128))
-                                        self.heatMap[(x - 1) * 2, (y - 1) * 2] += 1
-                except:
+                    values = UINT8.unpack_from(buffer, offset)[0]
+                except struct.error:
                     return 0x99
+                offset += 1
+                self.timePlayed = self.timePlayed + values * 0.04
+            # Positions collected so far belong to the previous time slice
+            if self.timeSlices:
+                timeSlice = min(int(self.timePlayed) // HEATMAPTIMESLICE, HEATMAPTIMESLICES - 1)
+                if timeSlice != self.timeSlice:
+                    self.flushPositions()
+                    self.timeSlice = timeSlice
+
+        elif messageType == 0x10 and self.decodePlayerUpdates:  # update player
+            playerDict = self.playerDict
+            playerFields = self.playerFields
+            layouts = playerUpdateLayouts.setdefault(playerFields, {})
+            groupBits = GROUPBITS if self.playerGroups else 0
+            positions = self.positions
+            positionCount = self.positionCount
+            try:
+                while offset != endPos:
+                    flags, playerId = PLAYERUPDATEHEAD.unpack_from(buffer, offset)
+                    offset += 3
+                    p = playerDict[playerId].__dict__
+                    layout = layouts.get(flags)
+                    if layout is None:
+                        layout = getPlayerUpdateLayout(flags, playerFields)
+                    for kind, decoder, fields in layout:
+                        if kind == 0:
+                            values = decoder.unpack_from(buffer, offset)
+                            offset += decoder.size
+                            for field, index, count in fields:
+                                if count == 1:
+                                    p[field] = values[index]
+                                else:
+                                    p[field] = values[index:index + count]
+                        elif kind == 3:
+                            offset += decoder
+                        elif kind == 1:
+                            value, offset = getString(buffer, offset)
+                            if fields is not None:
+                                p[fields] = value
+                        else:
+                            value, offset = getVehicle(buffer, offset)
+                            if fields is not None:
+                                p[fields] = value
+                    # The player group only changes with the team or vehicle, so it isn't worked out per position
+                    if flags & groupBits:
+                        p['group'] = HEATMAPTEAMGROUPS.get(p['team'], HEATMAPNOTEAMGROUP) + (
+                            type(p['vehicle']) is tuple)
+                    # team, vehicle and isalive are decoded before pos, so this sees the state the position was
+                    # sent with. Without player groups every position is in HEATMAPNOTEAMGROUP.
+                    if flags & POSITIONBIT and p['isalive']:
+                        pos = p['pos']
+                        positions[positionCount] = pos[0]
+                        positions[positionCount + 1] = pos[2]
+                        positions[positionCount + 2] = p['group']
+                        positionCount += 3
+                        if positionCount == len(positions):
+                            self.positionCount = positionCount
+                            self.flushPositions()
+                            positionCount = 0
+            except:
+                return 0x99
+            finally:
+                self.positionCount = positionCount
 
         elif messageType == 0x11:  # add player
-            while self.stream.tell() - startPos != messageLength:
-                values = unpack(self.stream, "Bsss")
-                if values == -1:
+            while offset != endPos:
+                try:
+                    playerId = UINT8.unpack_from(buffer, offset)[0]
+                    name, offset = getString(buffer, offset + 1)
+                    hash, offset = getString(buffer, offset)
+                    ip, offset = getString(buffer, offset)
+                except struct.error:
                     return 0x99
                 p = Player()
-                p.id = values[0]
-                p.name = values[1]
-                p.hash = values[2]
-                p.ip = values[3]
-                self.playerDict[values[0]] = p
+                p.id = playerId
+                p.name = name
+                p.hash = hash
+                p.ip = ip
+                self.playerDict[playerId] = p
                 self.playerCount += 1
 
         elif messageType == 0x12:  # remove player
-            while self.stream.tell() - startPos != messageLength:
-                values = unpack(self.stream, "B")
-                if values == -1:
+            while offset != endPos:
+                try:
+                    values = UINT8.unpack_from(buffer, offset)[0]
+                except struct.error:
                     return 0x99
+                offset += 1
                 del self.playerDict[values]
                 self.playerCount -= 1
 
         elif messageType == 0x41:  # flaglist
-            while self.stream.tell() - startPos != messageLength:
-                values = unpack(self.stream, "HBHHHH")
-                if values == -1:
+            while offset != endPos:
+                try:
+                    values = FLAGENTRY.unpack_from(buffer, offset)
+                except struct.error:
                     return 0x99
+                offset += FLAGENTRY.size
                 self.flags.append(Flag(values[0], values[2], values[3], values[4], values[5]))
 
-        else:
-            self.stream.read(messageLength - 1)
+        # Any other message type was already skipped by moving the offset past it.
         return messageType
 
     # Returns when tick or round end recieved.
@@ -546,7 +1894,26 @@ class demoParser:
 class StatsParser:
     versions = {}
 
-    def __init__(self):
+    # parseProfile is the demoParser profile new demos are parsed with. The default "heatmap" decodes everything
+    # the statistics and heatmaps use, "stats" skips the heatmaps of the new demos to parse them much faster.
+    # useCache keeps the parse results in the demo cache, which is pruned to cacheMaxAge days and cacheMaxSize MB.
+    # fullRecompute counts every round again instead of continuing from the running sums in the statistics.
+    # streamDownloads parses downloaded demos as they are received instead of saving them to the demos folder first,
+    # archivePath is a folder to also save them to. heatMapTiles also renders the heatmaps of maps with a higher
+    # resolution than HEATMAPIMAGESIZE as tiles of every zoom level. heatMapChannelTypes are the HEATMAPCHANNELTYPES of
+    # the heatmap channels to collect from new demos and render next to the heatmaps.
+    def __init__(self, parseProfile="heatmap", useCache=True, cacheMaxAge=90, cacheMaxSize=1024, fullRecompute=False,
+                 streamDownloads=False, archivePath=None, heatMapTiles=False, heatMapChannelTypes=()):
+        self.parseProfile = parseProfile
+        self.heatMapTiles = heatMapTiles
+        self.heatMapChannelTypes = tuple(heatMapChannelTypes)
+        self.streamDownloads = streamDownloads
+        self.archivePath = archivePath
+        self.fullRecompute = fullRecompute
+        self.useCache = useCache
+        self.cacheMaxAge = cacheMaxAge
+        self.cacheMaxSize = cacheMaxSize
+        self.startParsing()
         self.downloadDemos()
         self.importStats()
         self.dataAggragation()
@@ -555,224 +1922,151 @@ class StatsParser:
         self.createMapList()
         self.copyData()
 
-    # Calculate statistics such as times played and average tickets based on data
+    # Calculate statistics such as times played and average tickets based on data. Routes keep running sums of their
+    # rounds, so only rounds added since the last export are counted and the sums of the routes are added up to their
+    # layer, gamemode and map. Only maps with new rounds are exported again.
     def statsCalc(self):
         if len(self.versions) != 0:
             print "Calculating & exporting statistics..."
+            changedMaps = []
             for versionname,version in self.versions.iteritems():
                 for mapname, map in version.iteritems():
-                    mapTotalTickets1 = 0
-                    mapTotalTickets2 = 0
-                    mapTotalDuration = 0
-                    for gameModeIndex, gameMode in enumerate(map.gameModes, start=0):
-                        gamemodeTotalTickets1 = 0
-                        gamemodeTotalTickets2 = 0
-                        gamemodeTotalDuration = 0
-                        for layerIndex, layer in enumerate(gameMode.layers, start=0):
-                            layerTotalTickets1 = 0
-                            layerTotalTickets2 = 0
-                            layerTotalDuration = 0
-                            for routeIndex, route in enumerate(layer.routes, start=0):
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[
-                                    routeIndex].timesPlayed = len(route.roundsPlayed)
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].timesPlayed += len(
-                                    route.roundsPlayed)
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].timesPlayed += len(route.roundsPlayed)
-                                if gameMode.name != "Co-Operative":
-                                    self.versions[versionname][mapname].timesPlayed += len(route.roundsPlayed)
-                                routeTotalTickets1 = 0
-                                routeTotalTickets2 = 0
-                                routeTotalDuration = 0
-                                winsTeam1 = 0
-                                winsTeam2 = 0
-                                draws = 0
-                                for parsedDemo in route.roundsPlayed:
-                                    if parsedDemo.ticketsTeam1 > parsedDemo.ticketsTeam2:
-                                        winsTeam1 += 1
-                                    elif parsedDemo.ticketsTeam2 > parsedDemo.ticketsTeam1:
-                                        winsTeam2 += 1
-                                    else:
-                                        draws += 1
-                                    routeTotalTickets1 += parsedDemo.ticketsTeam1
-                                    routeTotalTickets2 += parsedDemo.ticketsTeam2
-                                    routeTotalDuration += parsedDemo.duration
-                                    layerTotalTickets1 += parsedDemo.ticketsTeam1
-                                    layerTotalTickets2 += parsedDemo.ticketsTeam2
-                                    layerTotalDuration += parsedDemo.duration
-                                    gamemodeTotalTickets1 += parsedDemo.ticketsTeam1
-                                    gamemodeTotalTickets2 += parsedDemo.ticketsTeam2
-                                    gamemodeTotalDuration += parsedDemo.duration
-                                    if gameMode.name != "Co-Operative":
-                                        mapTotalTickets1 += parsedDemo.ticketsTeam1
-                                        mapTotalTickets2 += parsedDemo.ticketsTeam2
-                                        mapTotalDuration += parsedDemo.duration
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[
-                                    routeIndex].averageTicketsTeam1 = routeTotalTickets1 / len(route.roundsPlayed)
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[
-                                    routeIndex].averageTicketsTeam2 = routeTotalTickets2 / len(route.roundsPlayed)
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[
-                                    routeIndex].averageDuration = routeTotalDuration / len(route.roundsPlayed)
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[
-                                    routeIndex].winsTeam1 = winsTeam1
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[
-                                    routeIndex].winsTeam2 = winsTeam2
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].routes[routeIndex].draws += draws
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].winsTeam1 += winsTeam1
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].winsTeam2 += winsTeam2
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[layerIndex].draws += draws
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].winsTeam1 += winsTeam1
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].winsTeam2 += winsTeam2
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].draws += draws
-                                if gameMode.name != "Co-Operative":
-                                    self.versions[versionname][mapname].winsTeam1 += winsTeam1
-                                    self.versions[versionname][mapname].winsTeam2 += winsTeam2
-                                    self.versions[versionname][mapname].draws += draws
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                layerIndex].averageTicketsTeam1 = layerTotalTickets1 / \
-                                                                  self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                                                      layerIndex].timesPlayed
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                layerIndex].averageTicketsTeam2 = layerTotalTickets2 / \
-                                                                  self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                                                      layerIndex].timesPlayed
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                layerIndex].averageDuration = layerTotalDuration / \
-                                                              self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                                                  layerIndex].timesPlayed
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].averageTicketsTeam1 = gamemodeTotalTickets1 / \
-                                                                                                                          self.versions[
-                                                                                                                              versionname][mapname].gameModes[
-                                                                                              gameModeIndex].timesPlayed
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].averageTicketsTeam2 = gamemodeTotalTickets2 / \
-                                                                                                                          self.versions[
-                                                                                                                              versionname][mapname].gameModes[
-                                                                                              gameModeIndex].timesPlayed
-                                self.versions[versionname][mapname].gameModes[gameModeIndex].averageDuration = gamemodeTotalDuration / \
-                                                                                                                      self.versions[
-                                                                                                                          versionname][mapname].gameModes[
-                                                                                          gameModeIndex].timesPlayed
-                                if gameMode.name != "Co-Operative":
-                                    self.versions[versionname][mapname].averageTicketsTeam1 = mapTotalTickets1 / self.versions[versionname][mapname].timesPlayed
-                                    self.versions[versionname][mapname].averageTicketsTeam2 = mapTotalTickets2 / self.versions[versionname][mapname].timesPlayed
-                                    self.versions[versionname][mapname].averageDuration = mapTotalDuration / self.versions[versionname][mapname].timesPlayed
-
-            for versionname, version in self.versions.iteritems():
-                for mapname, map in version.iteritems():
-                    # Export the statistics to the /maps/mapname/statistics.json files but first remove large heatmap data.
-                    with safe_open_w("./data/" + versionname + "/" + mapname + "/statistics.json") as f:
-                        for gameModeIndex, gameMode in enumerate(map.gameModes, start=0):
-                            for layerIndex, layer in enumerate(gameMode.layers, start=0):
-                                for routeIndex, route in enumerate(layer.routes, start=0):
-                                    for demoIndex, demo in enumerate(route.roundsPlayed, start=0):
-                                        del self.versions[versionname][mapname].gameModes[gameModeIndex].layers[
-                                            layerIndex].routes[routeIndex].roundsPlayed[demoIndex].heatMap
-                        f.write(map.toJSON())
+                    mapChanged = self.fullRecompute
+                    mapTotals = RoundTotals()
+                    for gameMode in map.gameModes:
+                        gameModeTotals = RoundTotals()
+                        for layer in gameMode.layers:
+                            layerTotals = RoundTotals()
+                            for route in layer.routes:
+                                if route.countNewRounds():
+                                    mapChanged = True
+                                route.setStatistics(route)
+                                layerTotals.add(route)
+                            layerTotals.setStatistics(layer)
+                            gameModeTotals.add(layerTotals)
+                        gameModeTotals.setStatistics(gameMode)
+                        if gameMode.name != "Co-Operative":
+                            mapTotals.add(gameModeTotals)
+                    mapTotals.setStatistics(map)
+                    if mapChanged or not os.path.exists(roundStoreFilePath(versionname, mapname)):
+                        changedMaps.append((versionname, mapname, map))
+
+            for versionname, mapname, map in changedMaps:
+                # Export the statistics to the /maps/mapname/statistics.json files
+                with safe_open_w("./data/" + versionname + "/" + mapname + "/statistics.json") as f:
+                    for gameMode in map.gameModes:
+                        for layer in gameMode.layers:
+                            for route in layer.routes:
+                                route.loadStoredRounds()
+                                del route.countedRounds
+                    f.write(map.toJSON())
+                saveRoundStore(versionname, mapname, map)
             print "Calculation & export of statistics complete."
         else:
             print "Data to calculate and export statistics not found."
 
+    # Return the Map of a version, adding it to the statistics when it isn't there yet
+    def getMap(self, versionName, mapName):
+        if versionName not in self.versions:
+            self.versions[versionName] = {}
+        version = self.versions[versionName]
+        if mapName not in version:
+            version[mapName] = Map(mapName)
+        return version[mapName]
+
     # Map the parsedDemo to the correct structure in the statistics based on Map,GameMode,Layer,Route
+    # Returns the route the parsedDemo was added to, or None when it wasn't added.
     def demoToData(self,parsedDemo,updated):
-        if parsedDemo.map != 0 and ((parsedDemo.gameMode == "Co-Operative" and parsedDemo.playerCount > 2) or (
-                parsedDemo.gameMode != "Co-Operative" and parsedDemo.gameMode != "Skirmish" and parsedDemo.playerCount > 64) or (
-                                            parsedDemo.gameMode == "Skirmish" and parsedDemo.playerCount > 8)):
-            if parsedDemo.version in self.versions:
-                if parsedDemo.map in self.versions[parsedDemo.version]:
-                    gameModeFound = False
-                    for gameModeIndex, gameMode in enumerate(self.versions[parsedDemo.version][parsedDemo.map].gameModes,
-                                                             start=0):
-                        if gameMode.name == parsedDemo.gameMode:
-                            layerFound = False
-                            for layerIndex, layer in enumerate(
-                                    self.versions[parsedDemo.version][parsedDemo.map].gameModes[gameModeIndex].layers,
-                                    start=0):
-                                if layer.name == parsedDemo.layer:
-                                    routeFound = False
-                                    for routeIndex, route in enumerate(
-                                            self.versions[parsedDemo.version][parsedDemo.map].gameModes[
-                                                gameModeIndex].layers[
-                                                layerIndex].routes, start=0):
-                                        if route.id == parsedDemo.getFlagId():
-                                            self.versions[parsedDemo.version][parsedDemo.map].gameModes[
-                                                gameModeIndex].layers[
-                                                layerIndex].routes[routeIndex].roundsPlayed.append(parsedDemo)
-                                            if updated:
-                                                self.versions[parsedDemo.version][parsedDemo.map].gameModes[
-                                                    gameModeIndex].layers[
-                                                    layerIndex].routes[routeIndex].updated = True
-                                            routeFound = True
-                                    if not routeFound:
-                                        self.versions[parsedDemo.version][parsedDemo.map].gameModes[gameModeIndex].layers[
-                                            layerIndex].routes.append(Route(parsedDemo.getFlagId(),updated))
-                                        self.versions[parsedDemo.version][parsedDemo.map].gameModes[gameModeIndex].layers[
-                                            layerIndex].routes[-1].roundsPlayed.append(parsedDemo)
-                                layerFound = True
-                            if not layerFound:
-                                self.versions[parsedDemo.version][parsedDemo.map].gameModes[gameModeIndex].layers.append(
-                                    Layer(parsedDemo.layer))
-                                self.versions[parsedDemo.version][parsedDemo.map].gameModes[gameModeIndex].layers[
-                                    -1].routes.append(
-                                    Route(parsedDemo.getFlagId(),updated))
-                                self.versions[parsedDemo.version][parsedDemo.map].gameModes[gameModeIndex].layers[-1].routes[
-                                    0].roundsPlayed.append(
-                                    parsedDemo)
-                            gameModeFound = True
-                    if not gameModeFound:
-                        self.versions[parsedDemo.version][parsedDemo.map].gameModes.append(GameMode(parsedDemo.gameMode))
-                        self.versions[parsedDemo.version][parsedDemo.map].gameModes[-1].layers.append(
-                            Layer(parsedDemo.layer))
-                        self.versions[parsedDemo.version][parsedDemo.map].gameModes[-1].layers[0].routes.append(
-                            Route(parsedDemo.getFlagId(),updated))
-                        self.versions[parsedDemo.version][parsedDemo.map].gameModes[-1].layers[0].routes[
-                            0].roundsPlayed.append(parsedDemo)
-                else:
-                    self.versions[parsedDemo.version][parsedDemo.map] = Map(parsedDemo.map)
-                    self.versions[parsedDemo.version][parsedDemo.map].gameModes.append(GameMode(parsedDemo.gameMode))
-                    self.versions[parsedDemo.version][parsedDemo.map].gameModes[0].layers.append(Layer(parsedDemo.layer))
-                    self.versions[parsedDemo.version][parsedDemo.map].gameModes[0].layers[0].routes.append(
-                        Route(parsedDemo.getFlagId(),updated))
-                    self.versions[parsedDemo.version][parsedDemo.map].gameModes[0].layers[0].routes[0].roundsPlayed.append(
-                        parsedDemo)
-            else:
-                self.versions[parsedDemo.version] = {}
-                self.versions[parsedDemo.version][parsedDemo.map] = Map(parsedDemo.map)
-                self.versions[parsedDemo.version][parsedDemo.map].gameModes.append(GameMode(parsedDemo.gameMode))
-                self.versions[parsedDemo.version][parsedDemo.map].gameModes[0].layers.append(
-                    Layer(parsedDemo.layer))
-                self.versions[parsedDemo.version][parsedDemo.map].gameModes[0].layers[0].routes.append(
-                    Route(parsedDemo.getFlagId(),updated))
-                self.versions[parsedDemo.version][parsedDemo.map].gameModes[0].layers[0].routes[
-                    0].roundsPlayed.append(parsedDemo)
-
-
-    # Parse all PRdemo files in the demos folder. It also removes the files after parsing to avoid duplicate entries.
-    # This uses multiprocessing to devide the work among the cores.
-    def dataAggragation(self):
-        demosToParseCount = 0
+        if parsedDemo.isCounted():
+            layer = self.getMap(parsedDemo.version, parsedDemo.map).getGameMode(parsedDemo.gameMode).getLayer(parsedDemo.layer)
+            route = layer.getRoute(parsedDemo.getFlagId(), updated)
+            route.roundsPlayed.append(parsedDemo)
+            if updated:
+                route.updated = True
+            return route
+        return None
+
+
+    # Start the parser pool and submit the demos that are already in the demos folder. Downloaded demos are submitted
+    # as soon as they are complete, so they are parsed while other demos download and the statistics are imported.
+    # Parsed demos are collected as they finish and their heatmaps are merged into one heatmap per route right away,
+    # so the heatmaps held at any time depend on the number of routes rather than the number of demos.
+    def startParsing(self):
+        self.parsePool = multiprocessing.Pool(multiprocessing.cpu_count(), getMapInfo)
+        self.parseLock = threading.Lock()
+        self.demoFileCount = 0
+        self.submittedCount = 0
+        self.parsedCount = 0
+        self.parseError = None
+        # Paths of the demo files submitted to the parser pool, so a demo file is parsed once per run
+        self.submittedDemos = set()
+        # Parsed demos without their heatmaps by the path of their file, and the summed heatmaps by route
+        self.parsedDemos = []
+        self.heatMaps = HeatMapAccumulator()
+        # Downloads wait while this many demos are waiting to be parsed
+        self.maxParseBacklog = PARSEBACKLOG * multiprocessing.cpu_count()
+        self.downloads = None
         for demoFilePath in walkdir("./demos"):
-            demosToParseCount += 1
-        demosToParse = []
-        if demosToParseCount != 0:
-            for index, demoFilePath in enumerate(walkdir("./demos"), start=0):
-                if os.stat(demoFilePath).st_size > 10000:
-                    demosToParse.append(demoFilePath)
-            if len(demosToParse) != 0:
+            self.submitDemo(demoFilePath)
+
+    # Submit a demo file to the parser pool
+    def submitDemo(self, demoFilePath):
+        with self.parseLock:
+            self.demoFileCount += 1
+            # Partial downloads are left for the downloader to resume
+            if (os.stat(demoFilePath).st_size > 10000 and not demoFilePath.endswith(".part") and
+                    demoFilePath not in self.submittedDemos):
+                self.submittedDemos.add(demoFilePath)
+                self.submittedCount += 1
+                self.parsePool.apply_async(parseDemoFile, (demoFilePath, self.parseProfile, self.useCache,
+                                                           self.heatMapChannelTypes),
+                                           callback=self.collectParsedDemo)
+
+    # Number of submitted demos that aren't parsed yet
+    def parseBacklog(self):
+        with self.parseLock:
+            return self.submittedCount - self.parsedCount
+
+    # Merge the sparse heatmap of a parsed demo into the heatmap of its route and keep the demo without it until it's
+    # added to the statistics. Demos that don't count in the statistics are dropped. Called with the (path, ParsedDemo)
+    # results of parseDemoFile in the order the demos finish parsing.
+    def collectParsedDemo(self, parseResult):
+        demoFilePath, parsedDemo = parseResult
+        with self.parseLock:
+            self.parsedCount += 1
+            if isinstance(parsedDemo, Exception):
+                self.parseError = parsedDemo
+            elif parsedDemo.isCounted():
+                if parsedDemo._heatMap is not None:
+                    self.heatMaps.add(parsedDemo)
+                self.parsedDemos.append((demoFilePath, parsedDemo))
+
+    # Wait for the parsed PRdemo files of the demos folder and the downloads and add them to the statistics. It also
+    # removes the files after parsing to avoid duplicate entries. The demos are parsed by a multiprocessing pool to
+    # devide the work among the cores.
+    def dataAggragation(self):
+        if self.downloads is not None:
+            self.finishDownloads()
+        self.parsePool.close()
+        if self.demoFileCount != 0:
+            if self.submittedCount != 0:
                 print "Parsing valid new PRDemos..."
-                pool = multiprocessing.Pool(multiprocessing.cpu_count())
-                parsedDemos = pool.map_async(parseNewDemo, demosToParse,chunksize=1)
-                pool.close()
                 while (True):
-                    update_progress(len(demosToParse) - parsedDemos._number_left,len(demosToParse))
+                    update_progress(self.parsedCount, self.submittedCount)
+                    if self.parsedCount == self.submittedCount: break
                     time.sleep(0.5)
-                    if (parsedDemos.ready()): break
-                parsedDemos.wait()
-                update_progress(len(demosToParse), len(demosToParse))
-                parsedDemos = parsedDemos.get()
-                for parsedDemo in parsedDemos:
+                if self.parseError is not None:
+                    raise self.parseError
+                self.parsePool.join()
+                # Add the demos in the order of their files rather than the order they finished parsing in
+                for demoFilePath, parsedDemo in sorted(self.parsedDemos, key=lambda parsedDemo: parsedDemo[0]):
                     self.demoToData(parsedDemo,True)
+                self.parsedDemos = []
                 for f in [f for f in os.listdir("./demos") if f.endswith(".PRdemo")]:
                     os.remove(os.path.join("./demos", f))
-                print "\nParsing of new PRDemos(" + str(demosToParseCount) + ") complete."
+                if self.useCache:
+                    pruneDemoCache(self.cacheMaxAge, self.cacheMaxSize)
+                print "\nParsing of new PRDemos(" + str(self.demoFileCount) + ") complete."
             else:
                 print "There are no valid new PRDemos to parse."
         else:
@@ -782,12 +2076,8 @@ class StatsParser:
     # Create maplist.json with basic map statistics for map list overview
     def createMapList(self):
         mapList = MapList()
-        foundMapNames = False
-        try:
-            with open("./input/maps.json", 'r') as f:
-                mapNames = json2obj(f.read())
-                foundMapNames = True
-        except:
+        mapNames = getMapInfo()
+        if mapNames is None:
             print "Couldn't find /input/maps.json to generate display names from."
         if len(self.versions) > 0:
             print "Creating maplist..."
@@ -808,9 +2098,9 @@ class StatsParser:
                             mapList.maps[index].averageTicketsTeam2 = (mapList.maps[
                                                                        index].averageTicketsTeam2 + mapObject.averageTicketsTeam2) / 2
                     if mapfound == False:
-                        if foundMapNames:
-                            if hasattr(mapNames, mapname):
-                                mapObject.displayName = getattr(mapNames,mapname).displayName
+                        if mapNames is not None:
+                            if mapname in mapNames:
+                                mapObject.displayName = mapNames[mapname]['displayName']
                             else:
                                 mapObject.displayName = mapname
                         else:
@@ -827,96 +2117,218 @@ class StatsParser:
         else:
             print "There is no data to create maplist from."
 
-    # Import existing data.json files of each map and gets the parsedDemos to be able to re-calculate the statistics
+    # Import the existing statistics of each map to be able to continue them. The round store of a map is read when
+    # there is one, statistics.json files are only parsed for maps that don't have a round store yet.
     def importStats(self):
-        totalStatisticsCount = 0
+        roundStores = []
+        statisticsFiles = []
         for filepath in walkdir("./data"):
-            if fnmatch(filepath, "*statistics.json") is True:
-                totalStatisticsCount += 1
+            if fnmatch(filepath, "*" + ROUNDSTOREFILENAME) is True:
+                roundStores.append(filepath)
+            elif fnmatch(filepath, "*statistics.json") is True:
+                statisticsFiles.append(filepath)
+        roundStoreFolders = set(os.path.dirname(filepath) for filepath in roundStores)
+        statisticsFiles = [filepath for filepath in statisticsFiles if os.path.dirname(filepath) not in roundStoreFolders]
+        totalStatisticsCount = len(roundStores) + len(statisticsFiles)
         if totalStatisticsCount >= 1:
             print "Importing existing statistics..."
-            for index, filepath in enumerate(walkdir("./data"), start=0):
-                if fnmatch(filepath, "*statistics.json") is True:
-                    update_progress(index,totalStatisticsCount)
-                    with open(filepath, 'r') as f:
-                        importedMapStatistics = json2obj(f.read())
-                        for gamemode in importedMapStatistics.gameModes:
-                            for layer in gamemode.layers:
-                                for route in layer.routes:
-                                    for parsedDemo in route.roundsPlayed:
-                                        flags = []
-                                        for flag in parsedDemo.flags:
-                                            flags.append(Flag(flag.cpid, flag.x, flag.y, flag.z, flag.radius))
-                                        newDemo = ParsedDemo(parsedDemo.version, parsedDemo.date, str(parsedDemo.map),
-                                                             str(parsedDemo.gameMode), str(parsedDemo.layer),
-                                                             parsedDemo.duration, parsedDemo.playerCount,
-                                                             parsedDemo.ticketsTeam1, parsedDemo.ticketsTeam2, flags)
-                                        newDemo.completed = True
-                                        self.demoToData(newDemo,False)
-                    update_progress(totalStatisticsCount,totalStatisticsCount)
+            for index, filepath in enumerate(roundStores + statisticsFiles, start=0):
+                update_progress(index,totalStatisticsCount)
+                if index < len(roundStores):
+                    self.importRoundStore(filepath)
+                else:
+                    self.importStatisticsFile(filepath)
+            update_progress(totalStatisticsCount,totalStatisticsCount)
 
             print "\nImport of existing statistics(" + str(totalStatisticsCount) + ") complete."
         else:
             print "Existing statistics not found."
 
-    #Download new demos from servers defined in /input/config.json. Every demo that is downloaded is appended
-    #to the 'demos' list in the json to avoid duplicates.
+    # Import the routes of a round store. Their rounds are only loaded when the statistics of the map are exported,
+    # unless all statistics are recomputed.
+    def importRoundStore(self, filepath):
+        versionName, mapName, routes = loadRoundStore(filepath)
+        map = self.getMap(versionName, mapName)
+        for gameModeName, layerName, routeId, totals, storedRounds in routes:
+            route = map.getGameMode(gameModeName).getLayer(layerName).getRoute(routeId, False)
+            if self.fullRecompute:
+                route.roundsPlayed.extend(storedRounds.getParsedDemos())
+            else:
+                route.importStoredRounds(storedRounds, totals)
+
+    # Import a statistics.json file and get its parsedDemos to be able to re-calculate the statistics
+    def importStatisticsFile(self, filepath):
+        with open(filepath, 'r') as f:
+            importedMapStatistics = json2obj(f.read())
+            for gamemode in importedMapStatistics.gameModes:
+                for layer in gamemode.layers:
+                    for route in layer.routes:
+                        importedRoute = None
+                        for parsedDemo in route.roundsPlayed:
+                            flags = []
+                            for flag in parsedDemo.flags:
+                                flags.append(Flag(flag.cpid, flag.x, flag.y, flag.z, flag.radius))
+                            newDemo = ParsedDemo(parsedDemo.version, parsedDemo.date, str(parsedDemo.map),
+                                                 str(parsedDemo.gameMode), str(parsedDemo.layer),
+                                                 parsedDemo.duration, parsedDemo.playerCount,
+                                                 parsedDemo.ticketsTeam1, parsedDemo.ticketsTeam2, flags)
+                            newDemo.completed = True
+                            importedRoute = self.demoToData(newDemo,False)
+                        # Continue from the running sums of the route unless they don't match its rounds
+                        if importedRoute is not None and not self.fullRecompute and \
+                                hasattr(route, 'totalDuration') and \
+                                route.timesPlayed == len(importedRoute.roundsPlayed):
+                            importedRoute.importTotals(route)
+
+    #Download new demos from servers defined in /input/config.json. The names of the demos downloaded from every
+    #server are kept in /input/seendemos.db to avoid duplicates.
     def downloadDemos(self):
         try:
             with open('./input/config.json', 'r') as f:
                 if not os.path.exists("./demos"):
                     os.makedirs("./demos")
                 config = json2obj(f.read())
-                demosToDownload = []
-                toDownloadServerNames = []
-                serverNameList = []
-                if hasattr(config, 'prpath') and hasattr(config, 'webpath'):
-                    newServerConfig = ServerList(config.prpath,config.webpath)
-                elif hasattr(config, 'prpath'):
-                    newServerConfig = ServerList(config.prpath, None)
-                elif hasattr(config, 'webpath'):
-                    newServerConfig = ServerList(None, config.webpath)
-                else:
-                    newServerConfig = ServerList(None, None)
+                downloader = DemoDownloader()
+                if self.archivePath is not None:
+                    mkdir_p(self.archivePath)
+                self.seenDemos = SeenDemos()
+                # Demos in the seendemos.json of older versions are moved to the database
+                if os.path.exists("./input/seendemos.json"):
+                    for serverName, demos in loadJSONFile("./input/seendemos.json", {}).iteritems():
+                        self.seenDemos.add(serverName, demos)
+                    os.remove("./input/seendemos.json")
+                indexCache = loadJSONFile(INDEXCACHEPATH, {})
+                # The demos found by name, with the url of the first link they were found at and the servers that
+                # list them. Demos are saved to ./demos by name, so a demo listed by several servers or links is
+                # downloaded and parsed once.
+                foundDemoNames = []
+                foundDemos = {}
+                # The demos of servers in config.json files from before seendemos.db are moved to it
+                newServerConfig = ServerList(getattr(config, 'prpath', None), getattr(config, 'webpath', None))
+                migrateConfig = False
                 for serverIndex, server in enumerate(config.servers, start=0):
-                    demoDownloadLinks = []
-                    demos = server.demos
+                    if len(getattr(server, 'demos', [])) != 0:
+                        self.seenDemos.add(server.name, server.demos)
+                        migrateConfig = True
                     for linkIndex, link in enumerate(server.links, start=0):
-                        demoDownloadLinks.append(link)
-                        if fnmatch(link, "*.json"):
-                            crawlers = json2obj(urllib.urlopen(link).read())
-                            for crawler in crawlers:
-                                for demoUrlIndex, demoUrl in enumerate(crawler.Trackers, start=0):
-                                    if getDemoName(demoUrl) not in server.demos:
-                                        if server.name not in serverNameList:
-                                            serverNameList.append(server.name)
-                                        demosToDownload.append(demoUrl)
-                                        toDownloadServerNames.append(server.name)
-                                        demos.append(getDemoName(demoUrl))
-                        else:
-                            soup = BeautifulSoup(requests.get(link).text, 'html.parser')
-                            for demoUrl in [link + node.get('href') for node in soup.find_all('a') if
-                                            node.get('href').endswith('PRdemo')]:
-                                if getDemoName(demoUrl) not in server.demos:
-                                    if server.name not in serverNameList:
-                                        serverNameList.append(server.name)
-                                    demosToDownload.append(demoUrl)
-                                    toDownloadServerNames.append(server.name)
-                                    demos.append(getDemoName(demoUrl))
-                    newServerConfig.servers.append(Server(server.name, demoDownloadLinks, demos))
+                        # A link that can't be read is skipped, its demos are found again on the next run
+                        try:
+                            demoUrls = getDemoUrls(downloader, link, indexCache)
+                        except (requests.RequestException, requests.packages.urllib3.exceptions.HTTPError,
+                                IOError), e:
+                            print "Failed to get the PRDemos of " + server.name + " at " + link + ": " + str(e)
+                            continue
+                        for demoUrl in demoUrls:
+                            demoName = getDemoName(demoUrl)
+                            if demoName not in foundDemos:
+                                foundDemoNames.append(demoName)
+                                foundDemos[demoName] = (demoUrl, [])
+                            if server.name not in foundDemos[demoName][1]:
+                                foundDemos[demoName][1].append(server.name)
+                    newServerConfig.servers.append(Server(server.name, list(server.links)))
+                demosToDownload = []
+                serverNameList = []
+                for demoName in foundDemoNames:
+                    demoUrl, serverNames = foundDemos[demoName]
+                    newServerNames = [serverName for serverName in serverNames
+                                      if not self.seenDemos.contains(serverName, demoName)]
+                    if os.path.abspath("./demos/" + demoName) in self.submittedDemos:
+                        # Already in the demos folder, such as demos downloaded by a run that was stopped before
+                        # they were added to the seen demos, and parsed from there
+                        for serverName in newServerNames:
+                            self.seenDemos.add(serverName, [demoName])
+                    elif len(newServerNames) == len(serverNames):
+                        for serverName in serverNames:
+                            if serverName not in serverNameList:
+                                serverNameList.append(serverName)
+                        demosToDownload.append((demoUrl, serverNames))
+                    else:
+                        # Already parsed as a demo of another server
+                        for serverName in newServerNames:
+                            self.seenDemos.add(serverName, [demoName])
+                if migrateConfig:
+                    with safe_open_w("./input/config.json") as f:
+                        f.write(newServerConfig.toJSON())
+                with safe_open_w(INDEXCACHEPATH) as f:
+                    json.dump(indexCache, f)
                 if len(demosToDownload) != 0:
-                    print "Downloading available PRDemos from servers(" + ','.join(serverNameList) + ")..."
-                    for demoIndex, demoUrl in enumerate(demosToDownload, start=0):
-                        update_progress(demoIndex,len(demosToDownload))
-                        urllib.urlretrieve(demoUrl, "./demos/" + getDemoName(demoUrl))
-                    update_progress(len(demosToDownload), len(demosToDownload))
-                    print "\nAll available PRDemos from servers("+ str(len(demosToDownload)) + ") downloaded."
+                    print "Downloading available PRDemos from servers(" + ','.join(serverNameList) + ") in the background..."
+                    pool = ThreadPool(DOWNLOADTHREADS)
+                    self.finishedDownloads = 0
+                    self.downloads = (pool, pool.map_async(partial(self.downloadDemo, downloader), demosToDownload,
+                                                           chunksize=1), demosToDownload)
                 else:
                     print "There are no new PRDemos to download."
-                with safe_open_w("./input/config.json") as f:
-                    f.write(newServerConfig.toJSON())
-        except :
-            print "/input/config.json file not found. Can't download demos automatically."
+                    self.seenDemos.close()
+        except Exception, e:
+            if os.path.exists('./input/config.json'):
+                print "Can't download demos automatically: " + str(e)
+            else:
+                print "/input/config.json file not found. Can't download demos automatically."
+
+    # Run fetchDemo for one of the background downloads and count it as finished for the progress of finishDownloads,
+    # whether it succeeded or not.
+    def downloadDemo(self, downloader, demoToDownload):
+        try:
+            return self.fetchDemo(downloader, demoToDownload)
+        finally:
+            with self.parseLock:
+                self.finishedDownloads += 1
+
+    # Download a demo once the parser pool has room for it and submit it to be parsed. Returns whether it succeeded.
+    def fetchDemo(self, downloader, demoToDownload):
+        demoUrl, serverNames = demoToDownload
+        while self.parseBacklog() >= self.maxParseBacklog:
+            time.sleep(0.1)
+        demoFilePath = os.path.abspath("./demos/" + getDemoName(demoUrl))
+        if self.streamDownloads:
+            if self.archivePath is not None:
+                archiveFilePath = os.path.join(self.archivePath, getDemoName(demoUrl))
+            else:
+                archiveFilePath = None
+            # The host is busy until a parser process has received the whole demo
+            session, hostSlots = downloader.getSession(demoUrl)
+            with hostSlots:
+                parseResult = self.parsePool.apply_async(parseDemoUrl, (demoUrl, archiveFilePath, self.parseProfile,
+                                                                        self.useCache, self.heatMapChannelTypes))
+                parseResult.wait()
+            if parseResult.successful():
+                with self.parseLock:
+                    self.demoFileCount += 1
+                    self.submittedCount += 1
+                # Ordered among the other demos as if it was downloaded to demoFilePath
+                self.collectParsedDemo((demoFilePath, parseResult.get()))
+                return True
+        elif downloader.download(demoUrl, demoFilePath):
+            self.submitDemo(demoFilePath)
+            return True
+        return False
+
+    # Wait for the background downloads and add the demos that were downloaded to the seen demos of every server that
+    # lists them. Demos that failed to download are downloaded again on the next run.
+    def finishDownloads(self):
+        pool, downloads, demosToDownload = self.downloads
+        demosToDownloadCount = len(demosToDownload)
+        print "Finishing the downloads..."
+        while (True):
+            update_progress(self.finishedDownloads, demosToDownloadCount)
+            time.sleep(0.5)
+            if (downloads.ready()): break
+        downloaded = downloads.get()
+        pool.close()
+        update_progress(demosToDownloadCount, demosToDownloadCount)
+        print "\nAll available PRDemos from servers(" + str(downloaded.count(True)) + ") downloaded."
+        if False in downloaded:
+            print "Failed to download " + str(downloaded.count(False)) + " PRDemos, they will be retried on the next run."
+        downloadedDemos = {}
+        for (demoUrl, serverNames), demoDownloaded in zip(demosToDownload, downloaded):
+            if demoDownloaded:
+                for serverName in serverNames:
+                    downloadedDemos.setdefault(serverName, []).append(getDemoName(demoUrl))
+        for serverName, demoNames in downloadedDemos.iteritems():
+            self.seenDemos.add(serverName, demoNames)
+        self.seenDemos.close()
+        self.downloads = None
 
     #Generate heatmap data based on player locations. Includes importing of existing data through loading in
     #existing numpy matrixes (.npy) files found in the data folder for each route.
@@ -925,7 +2337,7 @@ class StatsParser:
         for versionname,version in self.versions.iteritems():
             for mapname, map in version.iteritems():
                 setattr(map, 'versionname', versionname)
-                mapsToGenerate.append(map)
+                mapsToGenerate.append((map, self.heatMaps.getMapHeatMaps(versionname, mapname), self.heatMapTiles))
         currentHeatMapCount = 1
         if len(mapsToGenerate) != 0:
             print "Generating heatmaps..."
@@ -937,6 +2349,7 @@ class StatsParser:
                 time.sleep(0.5)
                 if (generatedMaps.ready()): break
             generatedMaps.wait()
+            self.heatMaps = HeatMapAccumulator()
             update_progress(len(mapsToGenerate), len(mapsToGenerate))
             print "\nAll heatmaps(" + str(len(mapsToGenerate)) +") generated."
         else:
@@ -965,7 +2378,7 @@ class StatsParser:
                 webPath = json2obj(f.read()).webpath
                 for index, filepath in enumerate(walkdir("./data"), start=0):
                     head, tail = os.path.split(filepath)
-                    if fnmatch(filepath, "*.npy") is False:
+                    if fnmatch(filepath, "*.npy") is False and fnmatch(filepath, "*.npz") is False:
                         if not os.path.exists(webPath + "/data" + head.split("data")[1].replace("\\","/")):
                             os.makedirs(webPath + "/data" + head.split("data")[1].replace("\\","/"))
                         copyfile(filepath, webPath + "/data" + head.split("data")[1].replace("\\","/") + "/" + tail)
@@ -975,4 +2388,27 @@ class StatsParser:
 
 
 if __name__ == '__main__':
-    StatsParser()
\ No newline at end of file
+    argumentParser = argparse.ArgumentParser(description="Generate statistics and heatmaps from PRDemo files.")
+    argumentParser.add_argument("--profile", choices=PARSEPROFILES, default="heatmap",
+                                help="what to decode from new PRDemos (default: heatmap)")
+    argumentParser.add_argument("--no-cache", dest="useCache", action="store_false",
+                                help="don't use or update the cache of parsed PRDemos")
+    argumentParser.add_argument("--cache-max-age", type=float, default=90,
+                                help="days an unused entry stays in the cache of parsed PRDemos (default: 90)")
+    argumentParser.add_argument("--cache-max-size", type=float, default=1024,
+                                help="maximum size in MB of the cache of parsed PRDemos (default: 1024)")
+    argumentParser.add_argument("--full-recompute", action="store_true",
+                                help="recalculate the statistics from every round instead of only adding new rounds")
+    argumentParser.add_argument("--stream", action="store_true",
+                                help="parse downloaded PRDemos as they are received instead of saving them first")
+    argumentParser.add_argument("--archive", metavar="FOLDER",
+                                help="with --stream, also save the downloaded PRDemos to this folder")
+    argumentParser.add_argument("--heatmap-tiles", action="store_true",
+                                help="also render heatmaps with a higher resolution as tiles for zooming in")
+    argumentParser.add_argument("--heatmap-channels", nargs="+", choices=HEATMAPCHANNELTYPES, default=[],
+                                metavar="CHANNEL", help="also collect and render heatmaps of these channels: " +
+                                ", ".join(HEATMAPCHANNELTYPES))
+    arguments = argumentParser.parse_args()
+    StatsParser(arguments.profile, arguments.useCache, arguments.cache_max_age, arguments.cache_max_size,
+                arguments.full_recompute, arguments.stream, arguments.archive, arguments.heatmap_tiles,
+                arguments.heatmap_channels)
\ No newline at end of file